@@ -0,0 +1,250 @@
+"""microbenchmarks of the graph convolution, the models and the data path
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+
+every case runs on synthetic layouts of layout_size elements (__image__ not
+included), batch_size layouts per batch. results are written as json, and
+with --compare, the median times are compared with a baseline json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from models.data import build_vocab, layout_to_graph, build_layout_dataset
+from models.graph import GraphTripleConvStack
+from models.relation import NDNRelation
+from models.generation import NDNGeneration
+from models.refinement import NDNRefinement
+from benchmarks.synthetic import synthesize_layout, write_layouts
+
+
+category_list = ['image', 'text', 'background', 'header', 'text over image', 'header over image']
+pos_relation_list = ['surrounding', 'inside', 'left of', 'above', 'right of', 'below', 'unknown']
+
+CASES = [
+    'gcn_conv', 'gcn_stack',
+    'relation_train', 'relation_infer',
+    'generation_train', 'generation_infer',
+    'refinement_train', 'refinement_infer',
+    'data'
+]
+
+
+def synthesize_batch(vocab, layout_size, batch_size, rng):
+    """a batch of synthetic layouts merged into a big graph, like merge_layouts
+
+    Returns:
+        objs: (O, ), boxes: (O, 4), pos_triples: (T, 3)
+    """
+    all_objs, all_boxes, all_pos_triples = [], [], []
+    offset = 0
+    for _ in range(batch_size):
+        objs, boxes, pos_triples = layout_to_graph(synthesize_layout(layout_size, rng), vocab)
+        all_objs.append(objs)
+        all_boxes.append(boxes)
+        all_pos_triples.append(pos_triples + np.array([offset, 0, offset], dtype=np.int32))
+        offset += len(objs)
+
+    return np.concatenate(all_objs), np.concatenate(all_boxes), np.concatenate(all_pos_triples)
+
+
+def gradient_step(model, loss_fn):
+    """forward and backward of model, gradients are not applied"""
+    with tf.GradientTape() as tape:
+        loss = loss_fn()
+    gradients = tape.gradient(loss, model.trainable_variables)
+
+    return loss, gradients
+
+
+def build_case(name, objs, boxes, pos_triples, args):
+    """
+    Returns:
+        run: function running the case once
+    """
+    rng = np.random.RandomState(0)
+    s, p, o = [tf.constant(x) for x in pos_triples.T]
+    edges = tf.stack([s, o], axis=1)
+    random_vecs = lambda n, dim: tf.constant(rng.standard_normal((n, dim)).astype(np.float32))
+    obj_vecs, pred_vecs = random_vecs(len(objs), 64), random_vecs(len(pos_triples), 64)
+    objs, boxes = tf.constant(objs), tf.constant(boxes)
+
+    if name == 'gcn_conv':
+        # a stack of one layer, so the dense engine includes padding
+        gconv = GraphTripleConvStack([(128, 512, 128)], engine=args.gcn_engine, factorized=args.gcn_factorized, recompute=args.gcn_recompute)
+        obj_vecs, pred_vecs = random_vecs(len(objs), 128), random_vecs(len(pos_triples), 128)
+        return tf.function(lambda: gconv(obj_vecs, pred_vecs, edges, training=False))
+
+    if name == 'gcn_stack':
+        stack = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128)], engine=args.gcn_engine, factorized=args.gcn_factorized, recompute=args.gcn_recompute)
+        return tf.function(lambda: stack(obj_vecs, pred_vecs, edges, training=False))
+
+    if name.startswith('relation'):
+        relation = NDNRelation(category_list=category_list, relation_list=pos_relation_list, gcn_engine=args.gcn_engine, gcn_factorized=args.gcn_factorized, gcn_recompute=args.gcn_recompute)
+        if name == 'relation_train':
+            return tf.function(lambda: gradient_step(relation, lambda: tf.reduce_sum(
+                relation(obj_vecs, pred_vecs, s, o, pred_vecs=pred_vecs, training=True)['pred_cls'])))
+        return tf.function(lambda: relation(obj_vecs, pred_vecs, s, o, training=False))
+
+    if name.startswith('generation'):
+        generation = NDNGeneration(decode_mode=args.decode_mode, teacher_forcing=args.teacher_forcing, gcn_engine=args.gcn_engine, gcn_factorized=args.gcn_factorized, gcn_recompute=args.gcn_recompute)
+        if name == 'generation_train':
+            return tf.function(lambda: gradient_step(generation, lambda: tf.reduce_sum(
+                generation(objs, obj_vecs, pred_vecs, boxes, s, o, training=True)['pred_boxes'])))
+        return tf.function(lambda: generation(objs, obj_vecs, pred_vecs, boxes, s, o, training=False))
+
+    if name.startswith('refinement'):
+        refinement = NDNRefinement(gcn_engine=args.gcn_engine, gcn_factorized=args.gcn_factorized, gcn_recompute=args.gcn_recompute)
+        if name == 'refinement_train':
+            return tf.function(lambda: gradient_step(refinement, lambda: tf.reduce_sum(
+                refinement(obj_vecs, pred_vecs, boxes, s, o, training=True)['bb_predicted'])))
+        return tf.function(lambda: refinement(obj_vecs, pred_vecs, boxes, s, o, training=False))
+
+    raise ValueError('Invalid case "%s"' % name)
+
+
+def build_data_case(vocab, layout_size, batch_size, data_dir):
+    """parsing and batching of layout json by build_layout_dataset"""
+    write_layouts(data_dir, max(batch_size * 8, 64), layout_size, layout_size)
+    iterator = iter(build_layout_dataset(data_dir, vocab, batch_size=batch_size))
+
+    return lambda: next(iterator)
+
+
+def time_case(run, warmup, repeats):
+    """
+    Returns:
+        timings: list of seconds of every repeat
+    """
+    for _ in range(warmup):
+        tf.nest.map_structure(lambda x: x.numpy(), run())
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        # numpy() waits for the outputs
+        tf.nest.map_structure(lambda x: x.numpy(), run())
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def run_benchmarks(args):
+    vocab = build_vocab(category_list, pos_relation_list)
+    rng = np.random.RandomState(args.seed)
+    data_root = tempfile.mkdtemp(prefix='ndn-bench-')
+
+    results = []
+    try:
+        for layout_size in args.layout_sizes:
+            for batch_size in args.batch_sizes:
+                objs, boxes, pos_triples = synthesize_batch(vocab, layout_size, batch_size, rng)
+
+                for name in args.cases:
+                    if name == 'data':
+                        run = build_data_case(vocab, layout_size, batch_size, os.path.join(data_root, '%d_%d' % (layout_size, batch_size)))
+                    else:
+                        run = build_case(name, objs, boxes, pos_triples, args)
+
+                    timings = np.array(time_case(run, args.warmup, args.repeats)) * 1000
+                    result = {
+                        'case': name,
+                        'layout_size': layout_size,
+                        'batch_size': batch_size,
+                        'num_objs': int(len(objs)),
+                        'num_triples': int(len(pos_triples)),
+                        'median_ms': float(np.median(timings)),
+                        'mean_ms': float(np.mean(timings)),
+                        'min_ms': float(np.min(timings)),
+                        'repeats': args.repeats
+                    }
+                    results.append(result)
+                    print('%-18s layout_size: %3d. batch_size: %3d. median: %10.3fms. min: %10.3fms.' % (
+                        name, layout_size, batch_size, result['median_ms'], result['min_ms']))
+    finally:
+        shutil.rmtree(data_root, ignore_errors=True)
+
+    return {
+        'environment': {
+            'tensorflow': tf.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'decode_mode': args.decode_mode,
+            'teacher_forcing': args.teacher_forcing,
+            'gcn_engine': args.gcn_engine,
+            'gcn_factorized': args.gcn_factorized,
+            'gcn_recompute': args.gcn_recompute
+        },
+        'results': results
+    }
+
+
+def compare(report, baseline, threshold):
+    """print the ratio of the median times to the baseline
+
+    Returns:
+        regressions: number of cases slower than baseline by more than threshold
+    """
+    key = lambda r: (r['case'], r['layout_size'], r['batch_size'])
+    baseline_results = {key(r): r for r in baseline['results']}
+
+    regressions = 0
+    for result in report['results']:
+        if key(result) not in baseline_results:
+            continue
+
+        ratio = result['median_ms'] / baseline_results[key(result)]['median_ms']
+        regressed = ratio > 1 + threshold
+        regressions += regressed
+
+        print('%-18s layout_size: %3d. batch_size: %3d. baseline: %10.3fms. now: %10.3fms. ratio: %6.3f.%s' % (
+            result['case'], result['layout_size'], result['batch_size'],
+            baseline_results[key(result)]['median_ms'], result['median_ms'], ratio,
+            ' REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    int_list = lambda value: [int(x) for x in value.split(',')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=lambda value: value.split(','), default=CASES)
+    parser.add_argument('--layout_sizes', type=int_list, default=[4, 8, 16])
+    parser.add_argument('--batch_sizes', type=int_list, default=[1, 16])
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--decode_mode', default='batched')
+    parser.add_argument('--teacher_forcing', default='sequential')
+    parser.add_argument('--gcn_engine', choices=['sparse', 'dense'], default='sparse')
+    parser.add_argument('--no_factorized', dest='gcn_factorized', action='store_false')
+    parser.add_argument('--recompute', dest='gcn_recompute', action='store_true')
+    parser.add_argument('--output', default=None, help='json of the results')
+    parser.add_argument('--compare', default=None, help='json of baseline results')
+    parser.add_argument('--threshold', type=float, default=.1, help='slowdown reported as regression')
+    args = parser.parse_args()
+
+    for name in args.cases:
+        assert name in CASES, 'Invalid case "%s"' % name
+
+    report = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        sys.exit(1 if compare(report, baseline, args.threshold) else 0)
@@ -0,0 +1,82 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from models.data import LAYOUT_WIDTH, LAYOUT_HEIGHT
+
+
+# categories of the magazine dataset and how often they are drawn
+CATEGORIES = ['text', 'image', 'header', 'text over image', 'header over image', 'background']
+CATEGORY_WEIGHTS = [.45, .25, .12, .08, .05, .05]
+
+
+def synthesize_layout(num_elements, rng=np.random):
+    """a magazine-style layout in the json format of the dataset
+
+    the page is split into num_elements blocks by cutting the largest block
+    along its longer side, like the columns and rows of a magazine page
+
+    Args:
+        num_elements: number of elements, __image__ not included
+        rng: np.random.RandomState
+
+    Returns:
+        layout: dict, {category: [[x0, y0, x1, y1], ...]}
+    """
+    blocks = [(0., 0., LAYOUT_WIDTH, LAYOUT_HEIGHT)]
+
+    while len(blocks) < num_elements:
+        x0, y0, x1, y1 = blocks.pop(int(np.argmax([(b[2] - b[0]) * (b[3] - b[1]) for b in blocks])))
+        ratio = rng.uniform(.3, .7)
+
+        if x1 - x0 > y1 - y0:
+            x = x0 + (x1 - x0) * ratio
+            blocks += [(x0, y0, x, y1), (x, y0, x1, y1)]
+        else:
+            y = y0 + (y1 - y0) * ratio
+            blocks += [(x0, y0, x1, y), (x0, y, x1, y1)]
+
+    layout = {}
+    for x0, y0, x1, y1 in blocks:
+        # leave a margin between the blocks
+        margin_x, margin_y = (x1 - x0) * .05, (y1 - y0) * .05
+        box = [round(float(v), 2) for v in (x0 + margin_x, y0 + margin_y, x1 - margin_x, y1 - margin_y)]
+        layout.setdefault(rng.choice(CATEGORIES, p=CATEGORY_WEIGHTS), []).append(box)
+
+    return layout
+
+
+def write_layouts(output_dir, num_layouts, min_elements, max_elements, seed=0):
+    """write num_layouts synthetic layout json of min_elements to max_elements elements
+
+    Returns:
+        paths: list of written json
+    """
+    rng = np.random.RandomState(seed)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    paths = []
+    for idx in range(num_layouts):
+        layout = synthesize_layout(rng.randint(min_elements, max_elements + 1), rng)
+
+        path = os.path.join(output_dir, '%06d.json' % idx)
+        with open(path, 'w') as f:
+            json.dump(layout, f)
+        paths.append(path)
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--num_layouts', type=int, default=1000)
+    parser.add_argument('--min_elements', type=int, default=2)
+    parser.add_argument('--max_elements', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_layouts(args.output_dir, args.num_layouts, args.min_elements, args.max_elements, seed=args.seed)
@@ -1,18 +1,43 @@
 import os
+import sys
+import time
 import argparse
+import contextlib
+import collections
 import configparser
 import datetime
 
-from models.pipeline import NeuralDesignNetwork
-
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--save', action='store_true')
 parser.add_argument('--train', action='store_true')
 parser.add_argument('--test', action='store_true')
+parser.add_argument('--compile', action='store_true')
+parser.add_argument('--generate', action='store_true')
+parser.add_argument('--evaluate', action='store_true')
+parser.add_argument('--export_lite', action='store_true')
 parser.add_argument('--part', choices=['relation', 'generation', 'refinement', 'all'])
 parser.add_argument('--checkpoint_path', default=None)
+parser.add_argument('--checkpoint_dir', default=None)
 parser.add_argument('--output_dir', default=None)
+parser.add_argument('--input_dir', default=None)
+parser.add_argument('--layouts_per_shard', type=int, default=10000)
+parser.add_argument('--batch_size', type=int, default=None)
+parser.add_argument('--num_samples', type=int, default=1)
+parser.add_argument('--top_k', type=int, default=None)
+# checkpoint of tf.train.Checkpoint(classifier=LayoutClassifier()), to rerank with --top_k
+parser.add_argument('--classifier_checkpoint_path', default=None)
+# override profile_stages and profile_trace_steps of config.ini
+parser.add_argument('--profile_stages', action='store_true')
+parser.add_argument('--profile_trace_steps', default=None, help='start,stop')
+parser.add_argument('--quantization', choices=['none', 'float16', 'int8'], default='float16')
+# data-parallel training in num_workers local processes
+parser.add_argument('--num_workers', type=int, default=1)
+# set by launch_workers
+parser.add_argument('--worker_index', type=int, default=None)
+parser.add_argument('--run_name', default=None)
+# print the time of imports, model building and checkpoint restore
+parser.add_argument('--report_startup', action='store_true')
 args = parser.parse_args()
 
 config_parser = configparser.ConfigParser()
@@ -23,9 +48,65 @@ category_list = ['image', 'text', 'background', 'header', 'text over image', 'he
 pos_relation_list = ['surrounding', 'inside', 'left of', 'above', 'right of', 'below', 'unknown']
 size_relation_list = ['bigger', 'smaller', 'same', 'unknown']
 
+# tensorflow and the models are imported by the modes that use them,
+# startup_timings holds the wall time of the imports and the building of the models
+startup_timings = collections.OrderedDict()
+
+
+@contextlib.contextmanager
+def startup_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = startup_timings.get(name, 0.) + time.perf_counter() - start
+
+
+def build_model(config, mode, save=False, training=False, strategy=None, rerank=False):
+    """build NeuralDesignNetwork with the modules of mode only, see models.pipeline.required_modules"""
+    with startup_stage('import'):
+        from models.pipeline import NeuralDesignNetwork, required_modules
+
+    with startup_stage('build'):
+        return NeuralDesignNetwork(
+            category_list=category_list,
+            pos_relation_list=pos_relation_list,
+            size_relation_list=size_relation_list,
+            config=config,
+            save=save,
+            training=training,
+            strategy=strategy,
+            modules=required_modules(mode, config['part'], rerank=rerank))
+
+
+def report_startup(model):
+    """print startup_timings and the stages timed by model, e.g. restore"""
+    if not args.report_startup:
+        return
+
+    timings = collections.OrderedDict(startup_timings)
+    timings.update(model.timer.pop())
+    startup_timings.clear()
+
+    print('Startup. %s' % ' '.join('%s: %fs.' % (name, secs) for name, secs in timings.items()))
+
 
 if __name__ == '__main__':
-    current_time = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    current_time = args.run_name or datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+
+    if args.train and args.num_workers > 1 and args.worker_index is None:
+        # run this command in num_workers processes, each with its own worker index
+        from models.distributed import launch_workers
+        sys.exit(launch_workers(args.num_workers, sys.argv, run_name=current_time))
+
+    # the strategy must be built before any other tensorflow op
+    strategy = None
+    if args.worker_index is not None:
+        with startup_stage('import'):
+            from models.distributed import build_strategy
+        strategy = build_strategy()
+    is_chief = not args.worker_index
+
     model_config = {
         'learning_rate': config.getfloat('learning_rate'),
         'beta_1': config.getfloat('beta_1'),
@@ -34,52 +115,66 @@ if __name__ == '__main__':
         'test_data_dir': config['test_data_dir'],
         'sample_data_dir': config['sample_data_dir'],
         'mask_rate': config.getfloat('mask_rate'),
-        'part': args.part
+        'mask_seed': config.getint('mask_seed'),
+        'compile_steps': config.getboolean('compile_steps'),
+        'decode_mode': config['decode_mode'],
+        'teacher_forcing': config['teacher_forcing'],
+        'dense_gcn': [name for name in config['dense_gcn'].split(',') if name],
+        'factorized_gcn': config.getboolean('factorized_gcn'),
+        'recompute_grad': [name for name in config['recompute_grad'].split(',') if name],
+        'part': args.part,
+        'render_workers': config.getint('render_workers'),
+        'render_max_pending': config.getint('render_max_pending')
     }
 
     if args.train:
         checkpoint_dir = os.path.join(config['checkpoint_dir'], current_time)
         sample_dir = os.path.join(config['sample_dir'], current_time)
-        train_sample_dir = os.path.join(sample_dir, 'train')
         test_sample_dir = os.path.join(sample_dir, 'test')
 
         log_dir = os.path.join(config['log_dir'], current_time)
         
-        if args.save:
+        if args.save and is_chief:
             if not os.path.exists(checkpoint_dir):
                 os.makedirs(checkpoint_dir)
 
             if not os.path.exists(sample_dir):
-                os.makedirs(train_sample_dir)
                 os.makedirs(test_sample_dir)
                 
             if not os.path.exists(log_dir):
                 os.makedirs(log_dir)
         
+        # tf.profiler trace of the steps [start, stop)
+        profile_trace_steps = args.profile_trace_steps or config['profile_trace_steps']
+        profile_trace_steps = tuple(int(step) for step in profile_trace_steps.split(',')) if profile_trace_steps else None
+
         training_config = {
             'checkpoint_dir': checkpoint_dir,
             'log_dir': log_dir,
-            'train_sample_dir': train_sample_dir,
             'batch_size': config.getint('batch_size'),
+            'batching': config['batching'],
+            'edge_budget': config.getint('edge_budget'),
+            'bucket_boundaries': [int(boundary) for boundary in config['bucket_boundaries'].split(',')],
             'lambda_cls': config.getfloat('lambda_cls'),
             'lambda_recon': config.getfloat('lambda_recon'),
             'lambda_kl_1': config.getfloat('lambda_kl_1'),
             'lambda_kl_2': config.getfloat('lambda_kl_2'),
             'max_iteration_number': int(config.getfloat('max_iteration_number')),
             'checkpoint_every': int(config.getfloat('checkpoint_every')), 
+            'checkpoint_every_secs': config.getfloat('checkpoint_every_secs'),
+            'checkpoint_staging_dir': config['checkpoint_staging_dir'],
             'checkpoint_max_to_keep': config.getint('checkpoint_max_to_keep'),
-            'sample_every': int(config.getint('sample_every'))
+            'sample_every': int(config.getint('sample_every')),
+            'eval_every_steps': config.getint('eval_every_steps'),
+            'eval_every_secs': config.getfloat('eval_every_secs'),
+            'profile_stages': args.profile_stages or config.getboolean('profile_stages'),
+            'profile_trace_steps': profile_trace_steps
         }
 
         training_config = {**training_config, **model_config}
         
-        model = NeuralDesignNetwork(
-            category_list=category_list, 
-            pos_relation_list=pos_relation_list,
-            size_relation_list=size_relation_list,
-            config=training_config,
-            save=args.save, 
-            training=True)
+        model = build_model(training_config, 'train', save=args.save, training=True, strategy=strategy)
+        report_startup(model)
 
         model.run(training_config)
 
@@ -91,13 +186,71 @@ if __name__ == '__main__':
 
         assert args.checkpoint_path and args.output_dir
         
-        model = NeuralDesignNetwork(
-            category_list=category_list,
-            pos_relation_list=pos_relation_list,
-            size_relation_list=size_relation_list,
-            config=model_config,
-            save=args.save, 
-            training=False
-        )
+        model = build_model({**model_config, 'profile_stages': args.report_startup}, 'test', save=args.save)
 
         model.test(model_config, args.checkpoint_path, args.output_dir)
+        report_startup(model)
+
+    if args.evaluate:
+        # evaluate the checkpoints of a training run as they are written,
+        # set eval_every_steps and eval_every_secs to 0 to take evaluation out of training
+        assert args.checkpoint_dir
+
+        model_config['batch_size'] = config.getint('batch_size')
+        log_dir = os.path.join(config['log_dir'], os.path.basename(os.path.normpath(args.checkpoint_dir)))
+
+        model = build_model(model_config, 'evaluate')
+        report_startup(model)
+
+        model.evaluate_checkpoints(model_config, args.checkpoint_dir, log_dir)
+
+    if args.generate:
+        assert args.checkpoint_path and args.input_dir and args.output_dir
+        assert not args.top_k or (args.num_samples > 1 and args.classifier_checkpoint_path), \
+            '--top_k reranks --num_samples > 1 candidates with the classifier of --classifier_checkpoint_path'
+
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+
+        model = build_model({**model_config, 'profile_stages': args.report_startup}, 'generate', rerank=bool(args.top_k))
+
+        model.generate_dir(
+            model_config,
+            args.checkpoint_path,
+            args.input_dir,
+            args.output_dir,
+            batch_size=args.batch_size or config.getint('batch_size'),
+            num_samples=args.num_samples,
+            top_k=args.top_k,
+            classifier_checkpoint_path=args.classifier_checkpoint_path
+        )
+        report_startup(model)
+
+    if args.export_lite:
+        # export relation, generation and refinement to TFLite,
+        # run them with models.lite.LitePipeline.load(output_dir)
+        assert args.checkpoint_path and args.output_dir
+
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+
+        model_config['batch_size'] = args.batch_size or config.getint('batch_size')
+
+        model = build_model({**model_config, 'profile_stages': args.report_startup}, 'export')
+
+        model.export(model_config, args.checkpoint_path, args.output_dir, quantization=args.quantization)
+        report_startup(model)
+
+    if args.compile:
+        # compile layout json into shards,
+        # point data_dir, test_data_dir or sample_data_dir to output_dir to use them
+        assert args.input_dir and args.output_dir
+
+        from models.data import build_vocab, compile_layouts
+
+        compile_layouts(
+            args.input_dir,
+            args.output_dir,
+            vocab=build_vocab(category_list, pos_relation_list),
+            layouts_per_shard=args.layouts_per_shard
+        )
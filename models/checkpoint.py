@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+
+
+class AsyncCheckpointer:
+    """save checkpoints without waiting for slow storage
+
+    save() writes the checkpoint to a local staging directory, which is
+    a quick snapshot of the variables, then a background thread copies it to
+    `directory`, updates the checkpoint state and removes the checkpoints
+    beyond max_to_keep. at most one checkpoint is copied at a time
+
+    Args:
+        ckpt: tf.train.Checkpoint
+        directory: checkpoint directory, e.g. on shared storage. if None, snapshots are
+            taken and discarded, as on the workers other than chief in distributed training
+        max_to_keep: number of checkpoints kept in directory
+        staging_dir: local directory of snapshots, a temporary directory in /dev/shm by default.
+            only a temporary directory is removed by close()
+    """
+    def __init__(self, ckpt, directory, max_to_keep, staging_dir=None):
+        self.ckpt = ckpt
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+
+        self.owns_staging_dir = staging_dir is None
+        if staging_dir is None:
+            staging_dir = tempfile.mkdtemp(prefix='ndn-ckpt-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        os.makedirs(staging_dir, exist_ok=True)
+        self.staging_dir = staging_dir
+
+        # snapshots staged by this checkpointer, removed by close() if staging_dir is given
+        self.staging_paths = []
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+        # checkpoints in directory, oldest first
+        self.checkpoints = []
+        # (step, seconds) of finished background writes
+        self.write_timings = []
+
+    def save(self, step):
+        """snapshot the checkpoint of step and write it in background
+
+        Returns:
+            snapshot_secs: seconds the caller was blocked
+        """
+        start = time.time()
+
+        # back-pressure, the previous checkpoint must be written first
+        self.wait()
+
+        staging_path = self.ckpt.write(os.path.join(self.staging_dir, 'ckpt-%d' % step))
+        self.staging_paths.append(staging_path)
+        self.pending = self.executor.submit(self.write, staging_path, step)
+
+        return time.time() - start
+
+    def write(self, staging_path, step):
+        start = time.time()
+
+        if self.directory is None:
+            for staging_file in tf.io.gfile.glob(staging_path + '.*'):
+                tf.io.gfile.remove(staging_file)
+            return
+
+        # absolute, so pruning does not depend on the working directory
+        path = os.path.abspath(os.path.join(self.directory, os.path.basename(staging_path)))
+        os.makedirs(self.directory, exist_ok=True)
+        for staging_file in tf.io.gfile.glob(staging_path + '.*'):
+            tf.io.gfile.copy(staging_file, os.path.join(self.directory, os.path.basename(staging_file)), overwrite=True)
+            tf.io.gfile.remove(staging_file)
+
+        self.checkpoints.append(path)
+        while len(self.checkpoints) > self.max_to_keep:
+            for old_file in tf.io.gfile.glob(self.checkpoints.pop(0) + '.*'):
+                tf.io.gfile.remove(old_file)
+
+        # the state is updated last, so readers never see a partial checkpoint
+        # a copy, update_checkpoint_state may rewrite the paths of the list it is given
+        tf.compat.v1.train.update_checkpoint_state(self.directory, path, all_model_checkpoint_paths=list(self.checkpoints))
+
+        self.write_timings.append((step, time.time() - start))
+
+    def wait(self):
+        """wait until the pending checkpoint is written, raise its error if any"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def pop_write_timings(self):
+        write_timings, self.write_timings = self.write_timings, []
+        return write_timings
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+        if self.owns_staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            return
+
+        for staging_path in self.staging_paths:
+            for staging_file in tf.io.gfile.glob(staging_path + '.*'):
+                tf.io.gfile.remove(staging_file)
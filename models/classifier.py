@@ -1,6 +1,5 @@
 import tensorflow as tf
 from tensorflow import keras
-from tensorflow.python.ops.op_selector import graph_inputs
 from models.graph import GraphTripleConvStack
 from models.layers import build_mlp
 
@@ -12,7 +11,7 @@ class LayoutClassifier(keras.Model):
     3 fully connected layer
 
     """
-    def __init__(self):
+    def __init__(self, gcn_engine='sparse', gcn_factorized=True, gcn_recompute=False):
         super(LayoutClassifier, self).__init__()
         
         node_input = keras.layers.Input(shape=(64))
@@ -21,7 +20,7 @@ class LayoutClassifier(keras.Model):
         node_bb_feature = keras.layers.Dense(64, activation='relu')(node_bb_input)
         self.node_bb_embedding = keras.Model(inputs=[node_input, bb_input], outputs=[node_bb_feature])
 
-        self.g_encoder = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 128)])
+        self.g_encoder = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 128)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
 
         scorer_input = keras.layers.Input(shape=(128))
         scorer_hidden = keras.layers.Dense(512, activation='relu')(scorer_input)
@@ -31,6 +30,21 @@ class LayoutClassifier(keras.Model):
         self.scorer = keras.Model(inputs=[scorer_input], outputs=[scorer_result, scorer_feature])
     
     def call(self, inputs, training=True):
+        """score every layout of a batched graph
+
+        Args:
+            inputs: dict
+                obj_vecs: (O, 64)
+                pred_vecs: (T, 64)
+                s_idx: (T, )
+                o_idx: (T, )
+                boxes: (O, 4)
+                graph_ids: (O, ) layout of every element
+                num_graphs: optional, number of layouts
+
+        Returns:
+            result: dict, score (G, 2), feature (G, 128)
+        """
         result = {}
 
         obj_vecs = inputs['obj_vecs']
@@ -38,6 +52,8 @@ class LayoutClassifier(keras.Model):
         s_idx = inputs['s_idx']
         o_idx = inputs['o_idx']
         boxes = inputs['boxes']
+        graph_ids = inputs['graph_ids']
+        num_graphs = inputs.get('num_graphs', tf.reduce_max(graph_ids) + 1)
 
         edges = tf.stack([s_idx, o_idx], axis=1)
 
@@ -46,9 +62,15 @@ class LayoutClassifier(keras.Model):
         new_obj_vecs, new_pred_vecs = self.g_encoder(new_obj_vecs, pred_vecs, edges, training=training)
 
         # predicted_bb = self.node_to_bb(new_obj_vecs)
-        
-        graph_feature = tf.concat([new_obj_vecs, new_pred_vecs], axis=-1)
-        graph_feature = tf.reduce_mean(graph_feature, axis=0)
+
+        # graph feature is the mean of node and triple features of every layout
+        # triples belong to the layout of their subject
+        pred_graph_ids = tf.gather(graph_ids, s_idx)
+        graph_feature = tf.math.unsorted_segment_sum(new_obj_vecs, graph_ids, num_segments=num_graphs) \
+                        + tf.math.unsorted_segment_sum(new_pred_vecs, pred_graph_ids, num_segments=num_graphs)
+        graph_counts = tf.math.unsorted_segment_sum(tf.ones_like(graph_ids, dtype=tf.float32), graph_ids, num_segments=num_graphs) \
+                       + tf.math.unsorted_segment_sum(tf.ones_like(pred_graph_ids, dtype=tf.float32), pred_graph_ids, num_segments=num_graphs)
+        graph_feature = graph_feature / tf.reshape(graph_counts, (-1, 1))
 
         scorer_result, scorer_feature = self.scorer([graph_feature])
 
@@ -0,0 +1,485 @@
+import os
+import glob
+import json
+import math
+import multiprocessing
+from functools import partial
+import numpy as np
+
+
+LAYOUT_WIDTH = 64.
+LAYOUT_HEIGHT = 64.
+
+# written by compile_layouts, marks a directory of compiled shards
+SHARD_INDEX = 'index.json'
+SHARD_ARRAYS = ['objs', 'boxes', 'pos_triples', 'obj_offsets', 'triple_offsets']
+
+
+def build_vocab(category_list, pos_relation_list):
+    vocab = {
+        'object_name_to_idx': {},
+        'pos_pred_name_to_idx': {},
+        # 'size_pred_name_to_idx': {}
+    }
+
+    vocab['object_name_to_idx']['__image__'] = 0
+    vocab['pos_pred_name_to_idx']['__in_image__'] = 0
+    # vocab['size_pred_name_to_idx']['__in_image__'] = 0
+
+    for idx, item in enumerate(category_list):
+        vocab['object_name_to_idx'][item] = idx + 1
+
+    for idx, item in enumerate(pos_relation_list):
+        vocab['pos_pred_name_to_idx'][item] = idx + 1
+
+    # for idx, item in enumerate(size_relation_list):
+    #     vocab['size_pred_name_to_idx'][item] = idx + 1
+
+    return vocab
+
+
+def parse_layout(path, vocab):
+    """parse one layout json into a graph
+
+    Args:
+        path: path of layout json, {category: [[x0, y0, x1, y1], ...]}
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        objs: (N, ) int32, category index of every element, __image__ at the end
+        boxes: (N, 4) float32, [x0, y0, w, h] normalized by the size of layout
+        pos_triples: (T, 3) int32, [s, p, o], s and o are indices in objs
+    """
+    with open(path) as f:
+        layout = json.load(f)
+
+    return layout_to_graph(layout, vocab)
+
+
+def layout_to_graph(layout, vocab):
+    """build the graph of one layout, see parse_layout
+
+    Args:
+        layout: dict, {category: [[x0, y0, x1, y1], ...]}
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        objs, boxes, pos_triples
+    """
+    cur_obj = []
+    cur_boxes = []
+    for category in layout.keys():
+        for obj in layout[category]:
+            cur_obj.append(vocab['object_name_to_idx'][category])
+
+            x0, y0, x1, y1 = obj
+            x0 /= LAYOUT_WIDTH
+            y0 /= LAYOUT_HEIGHT
+            x1 /= LAYOUT_WIDTH
+            y1 /= LAYOUT_HEIGHT
+            w = x1 - x0
+            h = y1 - y0
+            cur_boxes.append(np.array([x0, y0, w, h], dtype=np.float32))
+
+    # at the end of one layout add __image__ item
+    cur_obj.append(vocab['object_name_to_idx']['__image__'])
+    cur_boxes.append(np.array([0, 0, 1, 1], dtype=np.float32))
+
+    objs = np.array(cur_obj, dtype=np.int32)
+    boxes = np.stack(cur_boxes).astype(np.float32)
+    pos_triples = build_triples(boxes, vocab)
+
+    return objs, boxes, pos_triples
+
+
+def label_relations(s_boxes, o_boxes, vocab):
+    """position relationship between subject and object boxes
+
+    Args:
+        s_boxes: (T, 4) [x0, y0, w, h] of subjects
+        o_boxes: (T, 4) [x0, y0, w, h] of objects
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        p: (T, ) int32, index of relationship
+    """
+    s_boxes = np.asarray(s_boxes, dtype=np.float32)
+    o_boxes = np.asarray(o_boxes, dtype=np.float32)
+
+    sx0, sy0, sw, sh = [s_boxes[:, i] for i in range(4)]
+    ox0, oy0, ow, oh = [o_boxes[:, i] for i in range(4)]
+
+    sx1, sy1 = sx0 + sw, sy0 + sh
+    ox1, oy1 = ox0 + ow, oy0 + oh
+
+    d0 = (sx0 + sx1) / 2 - (ox0 + ox1) / 2
+    d1 = (sy0 + sy1) / 2 - (oy0 + oy1) / 2
+    theta = np.arctan2(d1.astype(np.float64), d0.astype(np.float64))
+
+    # now we have 6 kinds of position relationship
+    # the first matched condition wins
+    conditions = [
+        (sx0 < ox0) & (sx1 > ox1) & (sy0 < oy0) & (sy1 > oy1),
+        (sx0 > ox0) & (sx1 < ox1) & (sy0 > oy0) & (sy1 < oy1),
+        (theta >= 3 * math.pi / 4) | (theta <= -3 * math.pi / 4),
+        (-3 * math.pi / 4 <= theta) & (theta < -math.pi / 4),
+        (-math.pi / 4 <= theta) & (theta < math.pi / 4),
+        (math.pi / 4 <= theta) & (theta < 3 * math.pi / 4),
+    ]
+    relations = ['surrounding', 'inside', 'left of', 'above', 'right of', 'below']
+    choices = [vocab['pos_pred_name_to_idx'][p] for p in relations]
+
+    return np.select(conditions, choices).astype(np.int32)
+
+
+def build_triples(boxes, vocab):
+    """position triples of the complete graph of one layout
+
+    Args:
+        boxes: (N, 4) [x0, y0, w, h], __image__ at the end
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        pos_triples: (T, 3) int32, [s, p, o], T = (N - 1)^2
+    """
+    # elements except __image__ are all connected to each other
+    n = len(boxes) - 1
+    s, o = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    s, o = s[s != o], o[s != o]
+
+    p = label_relations(boxes[s], boxes[o], vocab)
+
+    # add __in_image__ triples
+    in_image = np.arange(n)
+    pos_in_image = vocab['pos_pred_name_to_idx']['__in_image__']
+
+    pos_triples = np.concatenate([
+        np.stack([s, p, o], axis=1),
+        np.stack([in_image, np.full(n, pos_in_image), np.full(n, n)], axis=1)
+    ], axis=0)
+
+    return pos_triples.astype(np.int32)
+
+
+def relabel_triples(boxes, pos_triples, vocab):
+    """re-derive position relationship of triples from boxes, e.g. predicted boxes
+
+    Args:
+        boxes: (O, 4) [x0, y0, w, h]
+        pos_triples: (T, 3) [s, p, o]
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        pos_triples: (T, 3) int32, __in_image__ triples are kept
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    pos_triples = np.array(pos_triples, dtype=np.int32)
+    s, p, o = pos_triples[:, 0], pos_triples[:, 1], pos_triples[:, 2]
+
+    keep = p != vocab['pos_pred_name_to_idx']['__in_image__']
+    pos_triples[keep, 1] = label_relations(boxes[s[keep]], boxes[o[keep]], vocab)
+
+    return pos_triples
+
+
+def build_design_graph(categories, relations, vocab):
+    """build the graph of a design constraint
+
+    Args:
+        categories: list of category names of the elements
+        relations: list of [s, relation name, o], s and o are indices in categories,
+            relations between other elements are 'unknown'
+        vocab: vocab of NeuralDesignNetwork
+
+    Returns:
+        objs: (N, ) int32, __image__ at the end
+        pos_triples: (T, 3) int32, triples in the same order as build_triples
+    """
+    objs = [vocab['object_name_to_idx'][category] for category in categories]
+    objs.append(vocab['object_name_to_idx']['__image__'])
+    objs = np.array(objs, dtype=np.int32)
+
+    # use the order of build_triples, boxes only decide the relations
+    pos_triples = build_triples(np.zeros((len(objs), 4), dtype=np.float32), vocab)
+
+    n = len(objs) - 1
+    unknown = vocab['pos_pred_name_to_idx']['unknown']
+    pos_triples[:n * (n - 1), 1] = unknown
+
+    for s, p, o in relations:
+        assert s != o and 0 <= s < n and 0 <= o < n, 'Invalid relation %s' % [s, p, o]
+        # triples of s come after the (n - 1) triples of every previous element
+        pos_triples[s * (n - 1) + (o if o < s else o - 1), 1] = vocab['pos_pred_name_to_idx'][p]
+
+    return objs, pos_triples
+
+
+def concat_graphs(graphs):
+    """combine graphs into a big graph, like merge_layouts
+
+    Args:
+        graphs: list of (objs, pos_triples)
+
+    Returns:
+        objs: (O, ) int32
+        pos_triples: (T, 3) int32
+    """
+    obj_offsets = np.cumsum([0] + [len(objs) for objs, _ in graphs])
+
+    all_pos_triples = []
+    for (_, pos_triples), offset in zip(graphs, obj_offsets):
+        all_pos_triples.append(pos_triples + np.array([offset, 0, offset], dtype=np.int32))
+
+    objs = np.concatenate([objs for objs, _ in graphs]).astype(np.int32)
+    pos_triples = np.concatenate(all_pos_triples).astype(np.int32)
+
+    return objs, pos_triples
+
+
+def save_layout(path, objs, boxes, vocab):
+    """save one layout in the json format of the dataset
+
+    Args:
+        path: path of layout json
+        objs: (N, ) category index of every element, __image__ is skipped
+        boxes: (N, 4) [x0, y0, w, h] normalized by the size of layout
+        vocab: vocab of NeuralDesignNetwork
+    """
+    idx_to_name = {idx: name for name, idx in vocab['object_name_to_idx'].items()}
+
+    layout = {}
+    for obj, (x, y, w, h) in zip(objs, boxes):
+        if obj == vocab['object_name_to_idx']['__image__']:
+            continue
+
+        layout.setdefault(idx_to_name[int(obj)], []).append([
+            float(x * LAYOUT_WIDTH),
+            float(y * LAYOUT_HEIGHT),
+            float((x + w) * LAYOUT_WIDTH),
+            float((y + h) * LAYOUT_HEIGHT)
+        ])
+
+    with open(path, 'w') as f:
+        json.dump(layout, f)
+
+
+def compile_layouts(data_dir, output_dir, vocab, layouts_per_shard=10000):
+    """compile a directory of layout json into binary shards
+
+    every shard stores the layouts of the shard back to back in .npy files,
+    triples keep the indices local to their layout.
+    obj_offsets and triple_offsets have one more item than layouts,
+    layout i owns objs[obj_offsets[i]:obj_offsets[i + 1]]
+
+    Args:
+        data_dir: directory of layout json
+        output_dir: directory of shards
+        vocab: vocab of NeuralDesignNetwork
+        layouts_per_shard: max number of layouts in one shard
+
+    Returns:
+        num_layouts: number of compiled layouts
+    """
+    paths = sorted(glob.glob(os.path.join(data_dir, '*.json')))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    shards = []
+    with multiprocessing.Pool() as pool:
+        for shard_idx, start in enumerate(range(0, len(paths), layouts_per_shard)):
+            graphs = pool.map(partial(parse_layout, vocab=vocab), paths[start : start + layouts_per_shard], chunksize=64)
+
+            arrays = {
+                'objs': np.concatenate([objs for objs, _, _ in graphs]),
+                'boxes': np.concatenate([boxes for _, boxes, _ in graphs]),
+                'pos_triples': np.concatenate([pos_triples for _, _, pos_triples in graphs]),
+                'obj_offsets': np.cumsum([0] + [len(objs) for objs, _, _ in graphs]).astype(np.int64),
+                'triple_offsets': np.cumsum([0] + [len(pos_triples) for _, _, pos_triples in graphs]).astype(np.int64)
+            }
+
+            prefix = 'shard-%05d' % shard_idx
+            for name in SHARD_ARRAYS:
+                np.save(os.path.join(output_dir, '%s-%s.npy' % (prefix, name)), arrays[name])
+
+            shards.append({'prefix': prefix, 'num_layouts': len(graphs)})
+            print('Shard %s compiled, %d layouts.' % (prefix, len(graphs)))
+
+    with open(os.path.join(output_dir, SHARD_INDEX), 'w') as f:
+        json.dump({
+            'num_layouts': len(paths),
+            'layout_width': LAYOUT_WIDTH,
+            'layout_height': LAYOUT_HEIGHT,
+            'vocab': vocab,
+            'shards': shards
+        }, f, indent=2)
+
+    return len(paths)
+
+
+def is_compiled(data_dir):
+    return os.path.exists(os.path.join(data_dir, SHARD_INDEX))
+
+
+class LayoutShards:
+    """random access to the layouts of compiled shards
+
+    arrays are memory mapped, so only the layouts being read are loaded
+    """
+    def __init__(self, data_dir, vocab):
+        with open(os.path.join(data_dir, SHARD_INDEX)) as f:
+            index = json.load(f)
+
+        assert index['vocab'] == vocab, 'Shards in "%s" are compiled with another vocab' % data_dir
+
+        self.shards = []
+        for shard in index['shards']:
+            self.shards.append({
+                name: np.load(os.path.join(data_dir, '%s-%s.npy' % (shard['prefix'], name)), mmap_mode='r')
+                for name in SHARD_ARRAYS
+            })
+
+        # index of the first layout of every shard
+        self.shard_starts = np.cumsum([0] + [shard['num_layouts'] for shard in index['shards']])
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def __getitem__(self, idx):
+        shard_idx = np.searchsorted(self.shard_starts, idx, side='right') - 1
+        shard = self.shards[shard_idx]
+        layout_idx = idx - self.shard_starts[shard_idx]
+
+        obj_start, obj_end = shard['obj_offsets'][layout_idx : layout_idx + 2]
+        triple_start, triple_end = shard['triple_offsets'][layout_idx : layout_idx + 2]
+
+        objs = np.array(shard['objs'][obj_start : obj_end])
+        boxes = np.array(shard['boxes'][obj_start : obj_end])
+        pos_triples = np.array(shard['pos_triples'][triple_start : triple_end])
+
+        return objs, boxes, pos_triples
+
+
+def merge_layouts(objs, boxes, pos_triples):
+    """combine the layouts in one batch into a big graph
+
+    Args:
+        objs: (B, None) ragged int32
+        boxes: (B, None, 4) ragged float32
+        pos_triples: (B, None, 3) ragged int32, indices are local to every layout
+
+    Returns:
+        objs: (O, ) int32
+        boxes: (O, 4) float32
+        pos_triples: (T, 3) int32, indices are shifted to the big graph
+    """
+    import tensorflow as tf
+
+    # (B, )
+    obj_offsets = tf.cast(objs.row_starts(), tf.int32)
+    # (T, )
+    triple_offsets = tf.gather(obj_offsets, pos_triples.value_rowids())
+
+    flat_triples = pos_triples.flat_values
+    flat_triples = flat_triples + tf.stack(
+        [triple_offsets, tf.zeros_like(triple_offsets), triple_offsets], axis=1)
+
+    return objs.flat_values, boxes.flat_values, flat_triples
+
+
+def budget_batch_sizes(edge_budget, bucket_boundaries):
+    """number of layouts in a batch of every bucket
+
+    bucket i holds layouts of bucket_boundaries[i - 1] <= N < bucket_boundaries[i] elements,
+    __image__ included, so a layout of bucket i has at most (bucket_boundaries[i] - 2)^2 triples.
+    layouts of the last bucket are not bounded, they make batches of one layout
+
+    Returns:
+        batch_sizes: list, len(bucket_boundaries) + 1 batch sizes
+    """
+    return [max(1, edge_budget // max(1, (boundary - 2) ** 2)) for boundary in bucket_boundaries] + [1]
+
+
+def build_layout_dataset(data_dir, vocab, batch_size, shuffle=True, shuffle_files=True, repeat=True,
+                         num_shards=1, shard_index=0, edge_budget=None, bucket_boundaries=(4, 6, 8, 12, 16, 24),
+                         num_parallel_calls=None):
+    """build the input pipeline of a directory of layout json or compiled shards
+
+    layouts are read in parallel, every batch is merged into a big graph
+    inside the pipeline, and batches are prefetched ahead of the model
+
+    Args:
+        data_dir: directory of layout json, or shards written by compile_layouts
+        vocab: vocab of NeuralDesignNetwork
+        batch_size: number of layouts in one batch
+        shuffle: shuffle files with a buffer of 100
+        shuffle_files: read files (or compiled layouts) in random order
+        repeat: repeat the files forever
+        num_shards: number of workers reading data_dir, each one reads 1 / num_shards of the files
+        shard_index: index of the files read by this worker
+        edge_budget: if set, batch_size is ignored. layouts are grouped into buckets by their
+            number of elements, and a batch of a bucket has at most edge_budget triples
+        bucket_boundaries: increasing number of elements, see budget_batch_sizes
+        num_parallel_calls: parallel calls of parsing and merging, AUTOTUNE if None
+
+    Returns:
+        dataset: dataset of (objs, boxes, pos_triples)
+    """
+    # tensorflow is imported by the pipelines only, compile_layouts does not need it
+    import tensorflow as tf
+
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+
+    if is_compiled(data_dir):
+        shards = LayoutShards(data_dir, vocab)
+        read_layout = lambda idx: shards[idx]
+
+        dataset = tf.data.Dataset.range(len(shards))
+        num_files = len(shards)
+    else:
+        read_layout = lambda path: parse_layout(path.decode(), vocab)
+
+        # files are listed in a fixed order, so the shards of the workers are disjoint
+        dataset = tf.data.Dataset.list_files(os.path.join(data_dir, '*.json'), shuffle=False)
+        num_files = len(tf.io.gfile.glob(os.path.join(data_dir, '*.json')))
+
+    dataset = dataset.shard(num_shards, shard_index)
+    if shuffle_files:
+        dataset = dataset.shuffle(buffer_size=num_files)
+
+    def parse(item):
+        objs, boxes, pos_triples = tf.numpy_function(
+            read_layout, [item], [tf.int32, tf.float32, tf.int32])
+        objs.set_shape((None,))
+        boxes.set_shape((None, 4))
+        pos_triples.set_shape((None, 3))
+
+        return objs, boxes, pos_triples
+
+    if repeat:
+        dataset = dataset.repeat()
+
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=100)
+
+    dataset = dataset.map(parse, num_parallel_calls=num_parallel_calls)
+
+    if edge_budget:
+        batch_sizes = budget_batch_sizes(edge_budget, bucket_boundaries)
+        boundaries = tf.constant(bucket_boundaries, dtype=tf.int32)
+
+        def bucket(objs, boxes, pos_triples):
+            return tf.reduce_sum(tf.cast(tf.size(objs) >= boundaries, tf.int64))
+
+        # a window holds one batch of its bucket
+        dataset = dataset.apply(tf.data.experimental.group_by_window(
+            key_func=bucket,
+            reduce_func=lambda key, window: window.apply(tf.data.experimental.dense_to_ragged_batch(batch_size=max(batch_sizes))),
+            window_size_func=lambda key: tf.gather(tf.constant(batch_sizes, dtype=tf.int64), key)))
+    else:
+        dataset = dataset.apply(tf.data.experimental.dense_to_ragged_batch(batch_size=batch_size))
+
+    dataset = dataset.map(merge_layouts, num_parallel_calls=num_parallel_calls)
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import tensorflow as tf
+
+
+def find_free_ports(num_ports):
+    sockets = []
+    for _ in range(num_ports):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+
+    return ports
+
+
+def launch_workers(num_workers, argv, run_name):
+    """run the command argv in num_workers local processes
+
+    every process gets the TF_CONFIG of a localhost cluster, its worker index
+    and the same run name, so checkpoints and logs of the run share a directory.
+    if a worker fails, the others are terminated, as they would wait for it forever
+
+    Args:
+        num_workers: number of processes
+        argv: command line of main.py, without the python executable
+        run_name: name of the checkpoint and log directories of the run
+
+    Returns:
+        returncode: 0 if all the workers succeeded
+    """
+    cluster = {'worker': ['localhost:%d' % port for port in find_free_ports(num_workers)]}
+
+    processes = []
+    for idx in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': idx}}))
+        processes.append(subprocess.Popen(
+            [sys.executable] + argv + ['--worker_index', str(idx), '--run_name', run_name], env=env))
+
+    try:
+        while True:
+            returncodes = [p.poll() for p in processes]
+
+            if any(returncode for returncode in returncodes):
+                break
+
+            if all(returncode is not None for returncode in returncodes):
+                return 0
+
+            time.sleep(1)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+
+    return next(returncode for returncode in returncodes if returncode)
+
+
+def build_strategy():
+    """build the data-parallel strategy of a worker started by launch_workers
+
+    must be called before any other tensorflow op. the cpu cores are shared
+    by the workers, and gradients are all-reduced with ring collectives
+    """
+    num_workers = len(json.loads(os.environ['TF_CONFIG'])['cluster']['worker'])
+    tf.config.threading.set_intra_op_parallelism_threads(max(1, os.cpu_count() // num_workers))
+
+    return tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING))
+
+
+def worker_info(strategy):
+    """
+    Returns:
+        num_workers: number of workers of strategy, 1 without a cluster
+        worker_index: index of this worker, 0 is chief
+    """
+    cluster_resolver = getattr(strategy, 'cluster_resolver', None)
+    if cluster_resolver is None or not cluster_resolver.cluster_spec().as_dict():
+        return 1, 0
+
+    return cluster_resolver.cluster_spec().num_tasks('worker'), cluster_resolver.task_id
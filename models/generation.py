@@ -1,14 +1,25 @@
 import tensorflow as tf
 from tensorflow import keras
-from models.graph import GraphTripleConvStack
+from models.graph import GraphTripleConvStack, layout_offsets, tile_edges
 from models.layers import build_mlp
-import tensorflow_probability as tfp
 
 
 class NDNGeneration(keras.Model):
-    def __init__(self):
+    def __init__(self, decode_mode='batched', teacher_forcing='sequential', gcn_engine='sparse', gcn_factorized=True, gcn_recompute=False):
         super(NDNGeneration, self).__init__()
-        self.g_enc = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128)])
+
+        # sequential: decode layouts one by one
+        # batched: decode step k of every layout at once, only used in inference
+        assert decode_mode in ['sequential', 'batched'], 'Invalid decode_mode "%s"' % decode_mode
+        self.decode_mode = decode_mode
+
+        # sequential: run the k steps of teacher forcing one by one
+        # parallel: run the k steps of teacher forcing in one g_update call,
+        # batch normalization of g_update takes the statistics of every step on its own
+        assert teacher_forcing in ['sequential', 'parallel'], 'Invalid teacher_forcing "%s"' % teacher_forcing
+        self.teacher_forcing = teacher_forcing
+
+        self.g_enc = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
         # self.g_update = GraphTripleConvStack([(128, 512, 128)])
         self.h_bb_dec = build_mlp(dim_list=[32 + 128, 128, 64, 4])
 
@@ -21,7 +32,7 @@ class NDNGeneration(keras.Model):
         g_update_input = tf.concat([g_update_f_input, g_update_b_input], axis=-1)
         g_update_hidden = keras.layers.Dense(128, activation=tf.nn.leaky_relu)(g_update_input)
         self.g_update_embedding = keras.Model(inputs=[g_update_f_input, g_update_b_input], outputs=[g_update_hidden])
-        self.g_update = GraphTripleConvStack([(128, 512, 128)])
+        self.g_update = GraphTripleConvStack([(128, 512, 128)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
 
         # build h_bb_encoder
         # h_bb_encoder take condition and bb_gt as input
@@ -46,7 +57,7 @@ class NDNGeneration(keras.Model):
         prior_var = keras.layers.Dense(32, activation=tf.nn.leaky_relu)(prior_x)
         self.prior_encoder = keras.Model(inputs=[prior_input], outputs=[prior_mu, prior_var])
     
-    def reparameterize(self, mu, var):
+    def reparameterize(self, mu, var, eps=None):
         """reparameterize trick for VAE
 
         sampling operation creates a bottleneck 
@@ -55,106 +66,296 @@ class NDNGeneration(keras.Model):
         Args:
             mu: mean of Normal distribution
             var: std of Normal distribution
+            eps: optional, noise sampled from N(0, 1), drawn here if not given
 
         Returns:
             z: a sample result
         """
-        eps = tf.random.normal(shape=mu.shape)
+        if eps is None:
+            eps = tf.random.normal(shape=tf.shape(mu))
         z = eps * tf.exp(var * .5) + mu
         return z
 
     def call(self, objs, obj_vecs, pred_vecs, boxes, s_idx, o_idx, training=True):
-        O = obj_vecs.shape[0]
-
-        result = {}
-        result['pred_boxes'] = []
-        result['mu'] = []
-        result['var'] = []
-        result['mu_prior'] = []
-        result['var_prior'] = []
-
         new_obj_vecs, new_pred_vecs = self.g_enc(obj_vecs, pred_vecs, tf.stack([s_idx, o_idx], axis=1), training=training)
         # (O, 128)
 
-        layout_size_list = []
-        layout_pred_size_list = []
-        temp_layout = []
-
-        for item in objs:
-            if item != 0:
-                temp_layout.append(item)
-            else:
-                layout_size_list.append(len(temp_layout) + 1)
-                temp_layout = []
-
-                # with N elements in layout
-                # we have N - 1 elements except __image__
-                # these N - 1 elements are all connected to each other
-                # so we have (N-1)(N-2) preds
-                # for __image__ item, it is connected to all other N - 1 elements
-                # so the final pred number is (N - 1)(N - 2) + (N - 1) = (N - 1)^2
-                layout_pred_size_list.append((layout_size_list[-1] - 1) ** 2)
-        
-        # simulate k iteration
+        if training and self.teacher_forcing == 'parallel':
+            return self.decode_teacher_forced(objs, new_obj_vecs, new_pred_vecs, boxes, s_idx, o_idx)
+
+        if not training and self.decode_mode == 'batched':
+            return self.decode_batched(objs, new_obj_vecs, new_pred_vecs, s_idx, o_idx)
+
+        return self.decode_sequential(objs, new_obj_vecs, new_pred_vecs, boxes, s_idx, o_idx, training=training)
+
+    def sample(self, objs, obj_vecs, pred_vecs, s_idx, o_idx, num_samples):
+        """decode num_samples layouts for every layout of the graph
+
+        g_enc runs once, then the samples are decoded in parallel
+        as disjoint copies of the graph
+
+        Returns:
+            result: dict, pred_boxes (num_samples * O, 4), sample m at [m * O, (m + 1) * O)
+        """
+        new_obj_vecs, new_pred_vecs = self.g_enc(obj_vecs, pred_vecs, tf.stack([s_idx, o_idx], axis=1), training=False)
+
+        tiled_s_idx, tiled_o_idx = tile_edges(s_idx, o_idx, tf.shape(objs)[0], num_samples)
+
+        return self.decode_batched(
+            tf.tile(objs, [num_samples]),
+            tf.tile(new_obj_vecs, [num_samples, 1]),
+            tf.tile(new_pred_vecs, [num_samples, 1]),
+            tiled_s_idx,
+            tiled_o_idx
+        )
+
+    def decode_sequential(self, objs, new_obj_vecs, new_pred_vecs, boxes, s_idx, o_idx, training=True):
+        O = tf.shape(new_obj_vecs)[0]
+
         # we have batch_size layout in objs
-        # we need to calculate c_k for different layout
-        # layout is marked by __image__ item, 
+        # layout is marked by __image__ item,
         # which is at the end of a list of elements
-        obj_offset = 0
-        pred_offset = 0
-        for idx, layout_size in enumerate(layout_size_list):
-            previous_bb = []
+        obj_offsets, layout_sizes, pred_offsets, pred_sizes = layout_offsets(objs)
+
+        # outputs are written at the flat index of their element,
+        # so they keep the order of objs
+        pred_boxes = tf.TensorArray(tf.float32, size=O, element_shape=(4,))
+        mu = tf.TensorArray(tf.float32, size=O, element_shape=(32,))
+        var = tf.TensorArray(tf.float32, size=O, element_shape=(32,))
+        mu_prior = tf.TensorArray(tf.float32, size=O, element_shape=(32,))
+        var_prior = tf.TensorArray(tf.float32, size=O, element_shape=(32,))
+
+        image_bb = tf.constant([0., 0., 1., 1.])
+
+        # simulate k iteration
+        # we need to calculate c_k for different layout
+        for idx in tf.range(tf.size(layout_sizes)):
+            obj_offset = obj_offsets[idx]
+            layout_size = layout_sizes[idx]
+            pred_offset = pred_offsets[idx]
+            pred_size = pred_sizes[idx]
+
             temp_obj_vecs = new_obj_vecs[obj_offset : obj_offset + layout_size]
-            temp_pred_vecs = new_pred_vecs[pred_offset : pred_offset + layout_pred_size_list[idx]]
-            temp_s_idx = s_idx[pred_offset : pred_offset + layout_pred_size_list[idx]] - obj_offset
-            temp_o_idx = o_idx[pred_offset : pred_offset + layout_pred_size_list[idx]] - obj_offset
-
-            for k in range(layout_size):
-                temp_bb = previous_bb.copy()
-                while len(temp_bb) < layout_size:
-                    temp_bb.append([0., 0., 0., 0.])
-                
-                temp_new_obj_vecs = self.g_update_embedding([temp_obj_vecs, tf.convert_to_tensor(temp_bb)], training=training)
-                temp_new_obj_vecs, temp_new_pred_vecs = self.g_update(temp_new_obj_vecs, temp_pred_vecs, tf.stack([temp_s_idx, temp_o_idx], axis=1), training=training)
+            temp_pred_vecs = new_pred_vecs[pred_offset : pred_offset + pred_size]
+            temp_s_idx = s_idx[pred_offset : pred_offset + pred_size] - obj_offset
+            temp_o_idx = o_idx[pred_offset : pred_offset + pred_size] - obj_offset
+            temp_edges = tf.stack([temp_s_idx, temp_o_idx], axis=1)
+
+            # bbox of the first k elements, the others are left as zeros
+            previous_bb = tf.zeros((layout_size, 4))
+
+            for k in tf.range(layout_size):
+                temp_new_obj_vecs = self.g_update_embedding([temp_obj_vecs, previous_bb], training=training)
+                temp_new_obj_vecs, temp_new_pred_vecs = self.g_update(temp_new_obj_vecs, temp_pred_vecs, temp_edges, training=training)
 
                 c_k = tf.reduce_mean(tf.concat([temp_new_obj_vecs, temp_new_pred_vecs], axis=0), axis=0)
+                c_k = tf.expand_dims(c_k, axis=0)
 
                 if training:
                     temp_boxes = tf.expand_dims(boxes[k + obj_offset], axis=0)
-                    c_k = tf.expand_dims(c_k, axis=0)
                     z_mu, z_var = self.h_bb_enc([temp_boxes, c_k], training=training)
-                    result['mu'].append(z_mu)
-                    result['var'].append(z_var)
+                    mu = mu.write(k + obj_offset, z_mu[0])
+                    var = var.write(k + obj_offset, z_var[0])
                     z = self.reparameterize(z_mu, z_var)
 
                     z_c_k = tf.concat([z, c_k], axis=-1)
                     bb_k_predicted = self.h_bb_dec(z_c_k, training=True)
                     bb_k_predicted = tf.squeeze(bb_k_predicted, axis=0)
-                    result['pred_boxes'].append(bb_k_predicted)
 
                     z_mu, z_var = self.prior_encoder(c_k)
-                    result['mu_prior'].append(z_mu)
-                    result['var_prior'].append(z_var)
-                    previous_bb.append(boxes[k + obj_offset])
+                    mu_prior = mu_prior.write(k + obj_offset, z_mu[0])
+                    var_prior = var_prior.write(k + obj_offset, z_var[0])
+                    bb_k = boxes[k + obj_offset]
 
                 else:
-                    c_k = tf.expand_dims(c_k, axis=0)
                     z_mu, z_var = self.prior_encoder(c_k)
                     z = self.reparameterize(z_mu, z_var)
                     z_c_k = tf.concat([z, c_k], axis=-1)
                     bb_k_predicted = self.h_bb_dec(z_c_k, training=False)
                     bb_k_predicted = tf.squeeze(bb_k_predicted, axis=0)
-                    result['pred_boxes'].append(bb_k_predicted)
 
                     # for __image__ item, use gt bbox
-                    if objs[obj_offset + k] == 0:
-                        previous_bb.append([0., 0., 1., 1.,])
-                    else:
-                        previous_bb.append(bb_k_predicted)
-                
-            # to maintain the size of predicted boxes
-            # add bbox for __image__ item
-            obj_offset += (layout_size)
-            pred_offset += (layout_pred_size_list[idx])
-        
+                    bb_k = tf.where(tf.equal(objs[k + obj_offset], 0), image_bb, bb_k_predicted)
+
+                pred_boxes = pred_boxes.write(k + obj_offset, bb_k_predicted)
+                previous_bb = tf.tensor_scatter_nd_update(previous_bb, [[k]], [bb_k])
+
+        result = {}
+        result['pred_boxes'] = pred_boxes.stack()
+
+        if training:
+            result['mu'] = mu.stack()
+            result['var'] = var.stack()
+            result['mu_prior'] = mu_prior.stack()
+            result['var_prior'] = var_prior.stack()
+
+        return result
+
+    def decode_batched(self, objs, new_obj_vecs, new_pred_vecs, s_idx, o_idx):
+        """decode step k of every layout at once
+
+        layouts are disjoint in the big graph, so one g_update over the big graph
+        gives the same features as one g_update per layout,
+        and the number of g_update calls is the size of the largest layout
+
+        Args:
+            objs: (O, ) category index of every element
+            new_obj_vecs: (O, 128) output of g_enc
+            new_pred_vecs: (T, 128) output of g_enc
+            s_idx: (T, )
+            o_idx: (T, )
+
+        Returns:
+            result: dict, pred_boxes (O, 4)
+        """
+        O = tf.shape(new_obj_vecs)[0]
+
+        obj_offsets, layout_sizes, pred_offsets, pred_sizes = layout_offsets(objs)
+        L = tf.size(layout_sizes)
+
+        # layout of every element and every triple
+        obj_layout = tf.repeat(tf.range(L), layout_sizes)
+        pred_layout = tf.gather(obj_layout, s_idx)
+        # number of features averaged into c_k
+        c_k_counts = tf.cast(tf.reshape(layout_sizes + pred_sizes, (-1, 1)), tf.float32)
+
+        edges = tf.stack([s_idx, o_idx], axis=1)
+        image_bb = tf.constant([0., 0., 1., 1.])
+
+        # bbox of the first k elements of every layout, the others are left as zeros
+        previous_bb = tf.zeros((O, 4))
+        pred_boxes = tf.zeros((O, 4))
+
+        for k in tf.range(tf.reduce_max(layout_sizes)):
+            # (L, 4)
+            bb_k_predicted = self.decode_step(new_obj_vecs, new_pred_vecs, edges, previous_bb, obj_layout, pred_layout, c_k_counts)
+
+            # only layouts with more than k elements are still decoding
+            decoding = k < layout_sizes
+            bb_k_predicted = tf.boolean_mask(bb_k_predicted, decoding)
+            k_idx = tf.reshape(tf.boolean_mask(obj_offsets + k, decoding), (-1, 1))
+
+            pred_boxes = tf.tensor_scatter_nd_update(pred_boxes, k_idx, bb_k_predicted)
+
+            # for __image__ item, use gt bbox
+            is_image = tf.equal(tf.gather_nd(objs, k_idx), 0)
+            bb_k = tf.where(tf.reshape(is_image, (-1, 1)), image_bb, bb_k_predicted)
+            previous_bb = tf.tensor_scatter_nd_update(previous_bb, k_idx, bb_k)
+
+        result = {}
+        result['pred_boxes'] = pred_boxes
+
+        return result
+
+    def decode_step(self, new_obj_vecs, new_pred_vecs, edges, previous_bb, obj_layout, pred_layout, c_k_counts, eps=None):
+        """predict the box of step k of every layout, given the boxes of the previous steps
+
+        Args:
+            new_obj_vecs: (O, 128) output of g_enc
+            new_pred_vecs: (T, 128) output of g_enc
+            edges: (T, 2)
+            previous_bb: (O, 4) bbox of the first k elements of every layout, zeros for the others
+            obj_layout: (O, ) layout of every element
+            pred_layout: (T, ) layout of every triple
+            c_k_counts: (L, 1) number of elements and triples of every layout
+            eps: optional, (L, 32) noise of z
+
+        Returns:
+            bb_k_predicted: (L, 4)
+        """
+        L = tf.shape(c_k_counts)[0]
+
+        temp_new_obj_vecs = self.g_update_embedding([new_obj_vecs, previous_bb], training=False)
+        temp_new_obj_vecs, temp_new_pred_vecs = self.g_update(temp_new_obj_vecs, new_pred_vecs, edges, training=False)
+
+        # (L, 128)
+        c_k = tf.math.unsorted_segment_sum(temp_new_obj_vecs, obj_layout, num_segments=L) \
+              + tf.math.unsorted_segment_sum(temp_new_pred_vecs, pred_layout, num_segments=L)
+        c_k = c_k / c_k_counts
+
+        z_mu, z_var = self.prior_encoder(c_k)
+        z = self.reparameterize(z_mu, z_var, eps=eps)
+        z_c_k = tf.concat([z, c_k], axis=-1)
+
+        return self.h_bb_dec(z_c_k, training=False)
+
+    def decode_teacher_forced(self, objs, new_obj_vecs, new_pred_vecs, boxes, s_idx, o_idx):
+        """run all k steps of teacher forcing in one pass
+
+        with gt boxes as previous_bb, step k of a layout does not depend on
+        the previous steps. so for the k-th element of every layout,
+        we build a copy of its layout whose first k elements have gt boxes,
+        and evaluate all the copies as one big graph. batch normalization of g_update
+        uses the statistics of every copy, and updates its moving statistics copy by copy,
+        like the steps of decode_sequential
+
+        Args:
+            objs: (O, ) category index of every element
+            new_obj_vecs: (O, 128) output of g_enc
+            new_pred_vecs: (T, 128) output of g_enc
+            boxes: (O, 4) gt boxes
+            s_idx: (T, )
+            o_idx: (T, )
+
+        Returns:
+            result: dict, pred_boxes (O, 4), mu, var, mu_prior and var_prior (O, 32)
+        """
+        O = tf.shape(new_obj_vecs)[0]
+
+        obj_offsets, layout_sizes, pred_offsets, pred_sizes = layout_offsets(objs)
+
+        # layout of every element, and position of the element in its layout
+        obj_layout = tf.repeat(tf.range(tf.size(layout_sizes)), layout_sizes)
+        obj_pos = tf.ragged.range(layout_sizes).flat_values
+
+        # the copy of element e is the layout of e, with step k = obj_pos[e]
+        copy_sizes = tf.gather(layout_sizes, obj_layout)
+        copy_pred_sizes = tf.gather(pred_sizes, obj_layout)
+        copy_offsets = tf.cumsum(copy_sizes, exclusive=True)
+
+        # (sum N^2, ) copy of every node and the element it is copied from
+        node_copy = tf.repeat(tf.range(O), copy_sizes)
+        node_pos = tf.ragged.range(copy_sizes).flat_values
+        node_src = tf.gather(obj_offsets, tf.gather(obj_layout, node_copy)) + node_pos
+
+        # (sum N(N - 1)^2, ) copy of every edge and the triple it is copied from
+        edge_copy = tf.repeat(tf.range(O), copy_pred_sizes)
+        edge_src = tf.gather(tf.gather(pred_offsets, obj_layout), edge_copy) \
+                   + tf.ragged.range(copy_pred_sizes).flat_values
+
+        # shift the edges from the layout to its copy
+        edge_shift = tf.gather(copy_offsets, edge_copy) - tf.gather(tf.gather(obj_offsets, obj_layout), edge_copy)
+        copy_edges = tf.stack([
+            tf.gather(s_idx, edge_src) + edge_shift,
+            tf.gather(o_idx, edge_src) + edge_shift
+        ], axis=1)
+
+        # bbox of the first k elements, the others are left as zeros
+        has_bb = node_pos < tf.gather(obj_pos, node_copy)
+        copy_bb = tf.where(tf.reshape(has_bb, (-1, 1)), tf.gather(boxes, node_src), tf.zeros_like(tf.gather(boxes, node_src)))
+
+        copy_obj_vecs = self.g_update_embedding([tf.gather(new_obj_vecs, node_src), copy_bb], training=True)
+        copy_obj_vecs, copy_pred_vecs = self.g_update(
+            copy_obj_vecs, tf.gather(new_pred_vecs, edge_src), copy_edges, training=True,
+            obj_segments=(node_copy, O), pred_segments=(edge_copy, O))
+
+        # (O, 128)
+        c_k = tf.math.unsorted_segment_sum(copy_obj_vecs, node_copy, num_segments=O) \
+              + tf.math.unsorted_segment_sum(copy_pred_vecs, edge_copy, num_segments=O)
+        c_k = c_k / tf.cast(tf.reshape(copy_sizes + copy_pred_sizes, (-1, 1)), tf.float32)
+
+        result = {}
+
+        z_mu, z_var = self.h_bb_enc([boxes, c_k], training=True)
+        result['mu'] = z_mu
+        result['var'] = z_var
+        z = self.reparameterize(z_mu, z_var)
+
+        z_c_k = tf.concat([z, c_k], axis=-1)
+        result['pred_boxes'] = self.h_bb_dec(z_c_k, training=True)
+
+        z_mu, z_var = self.prior_encoder(c_k)
+        result['mu_prior'] = z_mu
+        result['var_prior'] = z_var
+
         return result
@@ -1,5 +1,88 @@
 import tensorflow as tf
-from models.layers import build_mlp
+from models.layers import build_mlp, apply_layers
+
+
+def layout_offsets(objs):
+    """locate every layout in a batched graph
+
+    layouts are concatenated in objs, each one closed by its __image__ item (index 0).
+    with N elements in layout, the (N - 1)(N - 2) triples between elements
+    and the N - 1 __in_image__ triples are stored consecutively,
+    so every layout owns (N - 1)^2 triples
+
+    Args:
+        objs: (O, ) category index of every element
+
+    Returns:
+        obj_offsets: (L, ) index of the first element of every layout
+        layout_sizes: (L, ) number of elements of every layout, __image__ included
+        pred_offsets: (L, ) index of the first triple of every layout
+        pred_sizes: (L, ) number of triples of every layout
+    """
+    # (L, )
+    image_idx = tf.cast(tf.reshape(tf.where(tf.equal(objs, 0)), (-1,)), tf.int32)
+    layout_sizes = image_idx - tf.concat([[-1], image_idx[:-1]], axis=0)
+    obj_offsets = image_idx + 1 - layout_sizes
+
+    pred_sizes = (layout_sizes - 1) ** 2
+    pred_offsets = tf.cumsum(pred_sizes, exclusive=True)
+
+    return obj_offsets, layout_sizes, pred_offsets, pred_sizes
+
+
+def tile_edges(s_idx, o_idx, num_nodes, num_samples):
+    """edges of num_samples disjoint copies of a graph
+
+    copy m owns nodes [m * num_nodes, (m + 1) * num_nodes),
+    so node features are tiled with tf.tile(vecs, [num_samples, 1])
+
+    Returns:
+        s_idx: (num_samples * T, )
+        o_idx: (num_samples * T, )
+    """
+    offsets = tf.repeat(tf.range(num_samples) * num_nodes, tf.size(s_idx))
+
+    return tf.tile(s_idx, [num_samples]) + offsets, tf.tile(o_idx, [num_samples]) + offsets
+
+
+def dense_index(edges, num_nodes):
+    """locate the nodes and edges of a batched graph in padded tensors
+
+    layouts are consecutive nodes, and no edge links two layouts, as in merge_layouts
+    and tile_edges. so a layout ends where no edge spans the gap to the next node.
+    node i of layout b goes to [b, i] of (B, N) tensors, the edge from node i to
+    node j to [b, i, j] of (B, N, N) tensors
+
+    Args:
+        edges: (T, 2) [s, o]
+        num_nodes: O
+
+    Returns:
+        obj_index: (O, 2) [b, i] of every node
+        pred_index: (T, 3) [b, i, j] of every edge
+        dense_shape: [B, N]
+    """
+    lo = tf.minimum(edges[:, 0], edges[:, 1])
+    hi = tf.maximum(edges[:, 0], edges[:, 1])
+
+    # number of edges spanning the gap between node k and k + 1
+    ones = tf.ones_like(lo)
+    crossing = tf.cumsum(
+        tf.math.unsorted_segment_sum(ones, lo, num_segments=num_nodes)
+        - tf.math.unsorted_segment_sum(ones, hi, num_segments=num_nodes))
+
+    # (O, ) 1 at the first node of every layout
+    starts = tf.concat([[1], tf.cast(tf.equal(crossing[:-1], 0), tf.int32)], axis=0)
+    obj_layout = tf.cumsum(starts) - 1
+    layout_offsets = tf.cast(tf.reshape(tf.where(tf.equal(starts, 1)), (-1,)), tf.int32)
+    obj_pos = tf.range(num_nodes) - tf.gather(layout_offsets, obj_layout)
+
+    obj_index = tf.stack([obj_layout, obj_pos], axis=1)
+    pred_index = tf.stack([
+        tf.gather(obj_layout, edges[:, 0]), tf.gather(obj_pos, edges[:, 0]), tf.gather(obj_pos, edges[:, 1])
+    ], axis=1)
+
+    return obj_index, pred_index, tf.stack([tf.size(layout_offsets), tf.reduce_max(obj_pos) + 1])
 
 
 class GraphTripleConv(tf.keras.Model):
@@ -7,7 +90,7 @@ class GraphTripleConv(tf.keras.Model):
     A single layer of scene graph convolution
     """
 
-    def __init__(self, input_dim, output_dim=None, hidden_dim=512, pooling='avg', mlp_normalization='none'):
+    def __init__(self, input_dim, output_dim=None, hidden_dim=512, pooling='avg', mlp_normalization='none', factorized=True):
         super(GraphTripleConv, self).__init__()
         if output_dim is None:
             output_dim = input_dim
@@ -16,6 +99,9 @@ class GraphTripleConv(tf.keras.Model):
         self.output_dim = output_dim
         self.hidden_dim = hidden_dim
 
+        # compute the first layer of net1 from projections of the nodes, see triple_hidden
+        self.factorized = factorized
+
         assert pooling in ['sum', 'avg'], 'Invalid pooling "%s"' % pooling
         self.pooling = pooling
         net1_layers = [3 * input_dim, hidden_dim, 2 * hidden_dim + output_dim]
@@ -27,9 +113,16 @@ class GraphTripleConv(tf.keras.Model):
         self.net2 = build_mlp(net2_layers, activation='leaky_relu', batch_norm='batch')
         # TODO: add init of net2
 
-    def call(self, obj_vecs, pred_vecs, edges, training=True):
-        O = obj_vecs.shape[0]
-        T = pred_vecs.shape[0]
+    def call(self, obj_vecs, pred_vecs, edges, training=True, obj_segments=None, pred_segments=None, update_statistics=True):
+        """
+        Args:
+            obj_segments: optional, (segment_ids, num_segments) of the nodes,
+                batch normalization of net2 uses the statistics of every segment, see segment_batch_norm
+            pred_segments: optional, (segment_ids, num_segments) of the edges, for net1
+            update_statistics: if False, batch normalization does not update its moving statistics
+        """
+        # O and T may be unknown while tracing, so take them from the runtime shape
+        O = tf.shape(obj_vecs)[0]
 
         Din, H, Dout = self.input_dim, self.hidden_dim, self.output_dim
 
@@ -37,52 +130,124 @@ class GraphTripleConv(tf.keras.Model):
         s_idx = edges[:, 0]
         o_idx = edges[:, 1]
 
-        # (T, D)
-        # cur_s_vecs = obj_vecs[s_idx.numpy()]
-        # cur_o_vecs = obj_vecs[o_idx.numpy()]
-        cur_s_vecs = []
-        cur_o_vecs = []
-
-        for idx in s_idx.numpy():
-            cur_s_vecs.append(obj_vecs[idx])
-        
-        for idx in o_idx.numpy():
-            cur_o_vecs.append(obj_vecs[idx])
-        
-        cur_s_vecs = tf.convert_to_tensor(cur_s_vecs)
-        cur_o_vecs = tf.convert_to_tensor(cur_o_vecs)
+        if self.factorized:
+            # (T, H)
+            s_hidden, p_hidden, o_hidden = self.triple_hidden(obj_vecs, pred_vecs)
+            t_hidden = tf.gather(s_hidden, s_idx) + p_hidden + tf.gather(o_hidden, o_idx)
+            new_t_vecs = apply_layers(
+                self.net1.layers[1:], t_hidden, segments=pred_segments, training=training, update_statistics=update_statistics)
+        else:
+            # (T, D)
+            cur_s_vecs = tf.gather(obj_vecs, s_idx)
+            cur_o_vecs = tf.gather(obj_vecs, o_idx)
 
-        # (T, 3 * D)
-        cur_t_vecs = tf.concat([cur_s_vecs, pred_vecs, cur_o_vecs], axis=1)
-        new_t_vecs = self.net1(cur_t_vecs, training=training)
+            # (T, 3 * D)
+            cur_t_vecs = tf.concat([cur_s_vecs, pred_vecs, cur_o_vecs], axis=1)
+            new_t_vecs = apply_layers(
+                self.net1.layers, cur_t_vecs, segments=pred_segments, training=training, update_statistics=update_statistics)
 
         # (T, x)
         new_s_vecs = new_t_vecs[:, :H]
         new_p_vecs = new_t_vecs[:, H: (H + Dout)]
         new_o_vecs = new_t_vecs[:, (H + Dout): (2 * H + Dout)]
 
-        # TODO: dtype should be determined by obj_vecs
         # (O, H)
-        pooled_obj_vecs = tf.zeros(shape=(O, H), dtype=tf.float32)
-        pooled_obj_vecs = tf.tensor_scatter_nd_add(
-            pooled_obj_vecs, tf.reshape(s_idx, (-1, 1)), new_s_vecs)
-        pooled_obj_vecs = tf.tensor_scatter_nd_add(
-            pooled_obj_vecs, tf.reshape(o_idx, (-1, 1)), new_o_vecs)
+        pooled_obj_vecs = tf.math.unsorted_segment_sum(new_s_vecs, s_idx, num_segments=O) \
+                          + tf.math.unsorted_segment_sum(new_o_vecs, o_idx, num_segments=O)
 
         if self.pooling == 'avg':
-            # (O, )
-            obj_counts = tf.zeros(O, dtype=tf.float32)
             # (T, )
-            ones = tf.ones(T, dtype=tf.float32)
-            obj_counts = tf.tensor_scatter_nd_add(
-                obj_counts, tf.reshape(s_idx, (-1, 1)), ones)
-            obj_counts = tf.tensor_scatter_nd_add(
-                obj_counts, tf.reshape(o_idx, (-1, 1)), ones)
+            ones = tf.ones_like(s_idx, dtype=pooled_obj_vecs.dtype)
+            # (O, )
+            obj_counts = tf.math.unsorted_segment_sum(ones, s_idx, num_segments=O) \
+                         + tf.math.unsorted_segment_sum(ones, o_idx, num_segments=O)
 
-            obj_counts = tf.clip_by_value(obj_counts, 1, O)
+            # a mean over the edges of every node, only isolated nodes are clipped.
+            # no upper bound, so the features of a layout do not depend on the graph it is batched in
+            obj_counts = tf.maximum(obj_counts, 1)
             pooled_obj_vecs = pooled_obj_vecs / tf.reshape(obj_counts, (-1, 1))
 
-        new_obj_vecs = self.net2(pooled_obj_vecs, training=training)
+        new_obj_vecs = apply_layers(
+            self.net2.layers, pooled_obj_vecs, segments=obj_segments, training=training, update_statistics=update_statistics)
+
+        return new_obj_vecs, new_p_vecs
+
+    def triple_hidden(self, obj_vecs, pred_vecs):
+        """first layer of net1, split by the subject, predicate and object part of its input
+
+        the kernel of concat([s, p, o]) is the stack of a subject, a predicate and an object block,
+        so every node is projected once instead of once per edge. the first layer of a triple is
+        s_hidden[s] + p_hidden + o_hidden[o], the bias is added to p_hidden
+
+        Args:
+            obj_vecs: (..., D)
+            pred_vecs: (..., D)
+
+        Returns:
+            s_hidden, o_hidden: like obj_vecs, with last dimension H
+            p_hidden: like pred_vecs, with last dimension H
+        """
+        D = self.input_dim
+        dense = self.net1.layers[0]
+
+        s_hidden = tf.tensordot(obj_vecs, dense.kernel[:D], axes=1)
+        p_hidden = tf.tensordot(pred_vecs, dense.kernel[D: 2 * D], axes=1) + dense.bias
+        o_hidden = tf.tensordot(obj_vecs, dense.kernel[2 * D:], axes=1)
+
+        return s_hidden, p_hidden, o_hidden
+
+    def call_dense(self, obj_vecs, pred_vecs, obj_mask, pred_mask, training=True, update_statistics=True):
+        """call on padded layouts, with the same weights as call
+
+        the triples of all the (i, j) pairs are built by broadcasting,
+        and pooling is a masked sum over the rows and columns of the pairs
+
+        Args:
+            obj_vecs: (B, N, D)
+            pred_vecs: (B, N, N, D), the edge from node i to node j at [b, i, j]
+            obj_mask: (B, N) 1 for nodes, 0 for padding
+            pred_mask: (B, N, N) 1 for edges, 0 for the other pairs
+            update_statistics: if False, batch normalization does not update its moving statistics
+
+        Returns:
+            new_obj_vecs: (B, N, Dout)
+            new_p_vecs: (B, N, N, Dout)
+        """
+        H, Dout = self.hidden_dim, self.output_dim
+
+        if self.factorized:
+            # (B, N, N, H)
+            s_hidden, p_hidden, o_hidden = self.triple_hidden(obj_vecs, pred_vecs)
+            t_hidden = tf.expand_dims(s_hidden, axis=2) + p_hidden + tf.expand_dims(o_hidden, axis=1)
+            new_t_vecs = apply_layers(self.net1.layers[1:], t_hidden, pred_mask, training=training, update_statistics=update_statistics)
+        else:
+            # (B, N, N, 3 * D)
+            pairs_shape = tf.shape(pred_vecs)
+            cur_t_vecs = tf.concat([
+                tf.broadcast_to(tf.expand_dims(obj_vecs, axis=2), pairs_shape),
+                pred_vecs,
+                tf.broadcast_to(tf.expand_dims(obj_vecs, axis=1), pairs_shape)
+            ], axis=-1)
+            # dense layers need the last dimension
+            cur_t_vecs.set_shape([None, None, None, 3 * self.input_dim])
+            new_t_vecs = apply_layers(self.net1.layers, cur_t_vecs, pred_mask, training=training, update_statistics=update_statistics)
+
+        # (B, N, N, x)
+        new_s_vecs = new_t_vecs[..., :H]
+        new_p_vecs = new_t_vecs[..., H: (H + Dout)]
+        new_o_vecs = new_t_vecs[..., (H + Dout): (2 * H + Dout)]
+
+        # (B, N, H), node i is the subject of row i and the object of column i
+        mask = tf.expand_dims(pred_mask, axis=-1)
+        pooled_obj_vecs = tf.reduce_sum(new_s_vecs * mask, axis=2) + tf.reduce_sum(new_o_vecs * mask, axis=1)
+
+        if self.pooling == 'avg':
+            # (B, N), clipped like call
+            obj_counts = tf.reduce_sum(pred_mask, axis=2) + tf.reduce_sum(pred_mask, axis=1)
+            obj_counts = tf.maximum(obj_counts, 1)
+            pooled_obj_vecs = pooled_obj_vecs / tf.expand_dims(obj_counts, axis=-1)
+
+        new_obj_vecs = apply_layers(self.net2.layers, pooled_obj_vecs, obj_mask, training=training, update_statistics=update_statistics)
 
         return new_obj_vecs, new_p_vecs
 
@@ -114,9 +279,19 @@ class GraphTripleConvNet(tf.keras.Model):
 
 
 class GraphTripleConvStack(tf.keras.Model):
-    def __init__(self, in_h_out_dim_list, pooling='avg', mlp_normalization='none'):
+    def __init__(self, in_h_out_dim_list, pooling='avg', mlp_normalization='none', engine='sparse', factorized=True, recompute=False):
         super(GraphTripleConvStack, self).__init__()
 
+        # in training, keep only the inputs of every layer and recompute its activations in the backward pass.
+        # moving statistics of batch normalization are only updated in the forward pass
+        self.recompute = recompute
+
+        # sparse: gather the triples of the edge list and pool them with segment sums
+        # dense: pad the layouts to (B, N) nodes and (B, N, N) pairs, see GraphTripleConv.call_dense.
+        # both use the same weights
+        assert engine in ['sparse', 'dense'], 'Invalid engine "%s"' % engine
+        self.engine = engine
+
         self.gconvs = []
         for dims in in_h_out_dim_list:
             d_in, d_hidden, d_out = dims
@@ -125,12 +300,68 @@ class GraphTripleConvStack(tf.keras.Model):
                 'hidden_dim': d_hidden,
                 'output_dim': d_out,
                 'pooling': pooling,
-                'mlp_normalization': mlp_normalization
+                'mlp_normalization': mlp_normalization,
+                'factorized': factorized
             }
             self.gconvs.append(GraphTripleConv(**gconv_kwargs))
 
-    def call(self, obj_vecs, pred_vecs, edges, training=True):
+    def call(self, obj_vecs, pred_vecs, edges, training=True, obj_segments=None, pred_segments=None):
+        """
+        Args:
+            obj_segments, pred_segments: optional, see GraphTripleConv.call. only the sparse engine
+                takes statistics by segment, so the dense engine is not used with them
+        """
+        if self.engine == 'dense' and obj_segments is None and pred_segments is None:
+            return self.call_dense(obj_vecs, pred_vecs, edges, training=training)
+
         for gconv in self.gconvs:
-            obj_vecs, pred_vecs = gconv(obj_vecs, pred_vecs, edges, training=training)
+            obj_vecs, pred_vecs = self.run_layer(
+                lambda obj_vecs, pred_vecs, update_statistics, gconv=gconv: gconv(
+                    obj_vecs, pred_vecs, edges, training=training, obj_segments=obj_segments, pred_segments=pred_segments,
+                    update_statistics=update_statistics),
+                obj_vecs, pred_vecs, training)
         
         return obj_vecs, pred_vecs
+
+    def run_layer(self, layer_fn, obj_vecs, pred_vecs, training):
+        """call layer_fn(obj_vecs, pred_vecs, update_statistics), with tf.recompute_grad if recompute is set in training
+
+        layer_fn closes over the other inputs, only float tensors are passed to tf.recompute_grad.
+        the recomputation in the backward pass does not update the moving statistics again
+        """
+        if not (self.recompute and training):
+            return layer_fn(obj_vecs, pred_vecs, True)
+
+        calls = []
+
+        def recomputed_fn(obj_vecs, pred_vecs):
+            # the first call is the forward pass, the next ones recompute it in the backward pass
+            update_statistics = not calls
+            calls.append(update_statistics)
+
+            return layer_fn(obj_vecs, pred_vecs, update_statistics)
+
+        return tf.recompute_grad(recomputed_fn)(obj_vecs, pred_vecs)
+
+    def call_dense(self, obj_vecs, pred_vecs, edges, training=True):
+        """pad the graph once, run every layer on the padded layouts, and unpad the outputs"""
+        obj_index, pred_index, dense_shape = dense_index(edges, tf.shape(obj_vecs)[0])
+        B, N = dense_shape[0], dense_shape[1]
+
+        obj_mask = tf.scatter_nd(obj_index, tf.ones(tf.shape(obj_index)[:1]), [B, N])
+        pred_mask = tf.scatter_nd(pred_index, tf.ones(tf.shape(pred_index)[:1]), [B, N, N])
+
+        # (B, N, D), (B, N, N, D)
+        D = obj_vecs.shape[-1]
+        obj_vecs = tf.scatter_nd(obj_index, obj_vecs, tf.stack([B, N, D]))
+        pred_vecs = tf.scatter_nd(pred_index, pred_vecs, tf.stack([B, N, N, D]))
+        obj_vecs.set_shape([None, None, D])
+        pred_vecs.set_shape([None, None, None, D])
+
+        for gconv in self.gconvs:
+            obj_vecs, pred_vecs = self.run_layer(
+                lambda obj_vecs, pred_vecs, update_statistics, gconv=gconv: gconv.call_dense(
+                    obj_vecs, pred_vecs, obj_mask, pred_mask, training=training, update_statistics=update_statistics),
+                obj_vecs, pred_vecs, training)
+
+        return tf.gather_nd(obj_vecs, obj_index), tf.gather_nd(pred_vecs, pred_index)
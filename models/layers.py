@@ -25,3 +25,95 @@ def build_mlp(dim_list, activation='relu', batch_norm='none', dropout=0, final_n
             mlp.add(tf.keras.layers.Dropout(rate=dropout))
 
     return mlp
+
+
+def masked_batch_norm(layer, x, mask, update_statistics=True):
+    """training forward of a BatchNormalization layer, statistics only over the masked entries
+
+    moving statistics are updated like the layer does, so the weights stay
+    interchangeable with calling the layer on the unpadded entries
+
+    Args:
+        layer: built tf.keras.layers.BatchNormalization on the last axis
+        x: (..., D)
+        mask: (...) 1 for valid entries, 0 for padding
+        update_statistics: if False, moving statistics are left as they are
+    """
+    mask = tf.expand_dims(tf.cast(mask, x.dtype), axis=-1)
+    axes = list(range(len(x.shape) - 1))
+    count = tf.maximum(tf.reduce_sum(mask), 1.)
+
+    mean = tf.reduce_sum(x * mask, axis=axes) / count
+    variance = tf.reduce_sum(tf.math.squared_difference(x, mean) * mask, axis=axes) / count
+
+    if update_statistics:
+        layer.moving_mean.assign(layer.moving_mean * layer.momentum + mean * (1 - layer.momentum))
+        layer.moving_variance.assign(layer.moving_variance * layer.momentum + variance * (1 - layer.momentum))
+
+    return tf.nn.batch_normalization(x, mean, variance, layer.beta, layer.gamma, layer.epsilon)
+
+
+def segment_batch_norm(layer, x, segments, update_statistics=True):
+    """training forward of a BatchNormalization layer, statistics of every segment on its own
+
+    the same as calling the layer on every segment one after the other,
+    moving statistics are updated once per non-empty segment, in the order of the segments
+
+    Args:
+        layer: built tf.keras.layers.BatchNormalization on the last axis
+        x: (M, D)
+        segments: (segment_ids, num_segments), segment_ids (M, )
+        update_statistics: if False, moving statistics are left as they are
+    """
+    segment_ids, num_segments = segments
+
+    # (S, 1)
+    counts = tf.math.unsorted_segment_sum(tf.ones_like(x[:, :1]), segment_ids, num_segments=num_segments)
+    mean = tf.math.unsorted_segment_sum(x, segment_ids, num_segments=num_segments) / tf.maximum(counts, 1.)
+    variance = tf.math.unsorted_segment_sum(
+        tf.math.squared_difference(x, tf.gather(mean, segment_ids)), segment_ids, num_segments=num_segments) / tf.maximum(counts, 1.)
+
+    if update_statistics:
+        # updates of C segments: moving * momentum^C + sum_i (1 - momentum) momentum^(C - 1 - i) value_i
+        nonempty = counts[:, 0] > 0
+        C = tf.reduce_sum(tf.cast(nonempty, tf.int32))
+        decay = (1 - layer.momentum) * layer.momentum ** tf.cast(tf.range(C - 1, -1, -1), x.dtype)
+        decay = tf.reshape(decay, (-1, 1))
+        momentum = layer.momentum ** tf.cast(C, x.dtype)
+
+        layer.moving_mean.assign(layer.moving_mean * momentum + tf.reduce_sum(decay * tf.boolean_mask(mean, nonempty), axis=0))
+        layer.moving_variance.assign(layer.moving_variance * momentum + tf.reduce_sum(decay * tf.boolean_mask(variance, nonempty), axis=0))
+
+    return tf.nn.batch_normalization(
+        x, tf.gather(mean, segment_ids), tf.gather(variance, segment_ids), layer.beta, layer.gamma, layer.epsilon)
+
+
+def apply_layers(layers, x, mask=None, segments=None, training=True, update_statistics=True):
+    """call layers of an mlp of build_mlp one after the other, e.g. mlp.layers
+
+    with mask, inputs are padded and may have any rank. Dense layers work on the last axis,
+    batch normalization uses masked statistics in training.
+    with segments, rows of x belong to separate graphs, and batch normalization
+    uses the statistics of every graph in training, see segment_batch_norm
+
+    Args:
+        layers: list of layers
+        x: (..., D)
+        mask: optional, (...) 1 for valid entries, 0 for padding
+        segments: optional, (segment_ids, num_segments)
+        update_statistics: if False, batch normalization does not update its moving statistics in training
+    """
+    for layer in layers:
+        is_batch_norm = isinstance(layer, tf.keras.layers.BatchNormalization)
+
+        if training and is_batch_norm and segments is not None:
+            x = segment_batch_norm(layer, x, segments, update_statistics)
+        elif training and is_batch_norm and (mask is not None or not update_statistics):
+            x = masked_batch_norm(layer, x, tf.ones_like(x[..., 0]) if mask is None else mask, update_statistics)
+        elif is_batch_norm and not training:
+            # the layer is built on (M, D) inputs, its inference is written out so x may have any rank
+            x = tf.nn.batch_normalization(x, layer.moving_mean, layer.moving_variance, layer.beta, layer.gamma, layer.epsilon)
+        else:
+            x = layer(x, training=training)
+
+    return x
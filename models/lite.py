@@ -0,0 +1,298 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+
+
+LITE_MODELS = ['relation', 'generation_encoder', 'generation_step', 'refinement']
+QUANTIZATIONS = ['none', 'float16', 'int8']
+
+IMAGE_BB = np.array([0., 0., 1., 1.], dtype=np.float32)
+
+
+def build_lite_functions(model):
+    """inference functions of NeuralDesignNetwork for export
+
+    embeddings are looked up outside, and the noise of relation and generation
+    is an input, so a converted model can be compared with the original one.
+    generation is split into g_enc and one decoding step, the loop over the steps
+    runs in LitePipeline
+
+    Args:
+        model: NeuralDesignNetwork
+
+    Returns:
+        functions: dict of tf.function, keyed by LITE_MODELS
+    """
+    vec_spec = lambda dim: tf.TensorSpec(shape=(None, dim), dtype=tf.float32)
+    idx_spec = tf.TensorSpec(shape=(None,), dtype=tf.int32)
+
+    @tf.function(input_signature=[vec_spec(64), vec_spec(64), idx_spec, idx_spec, vec_spec(32)])
+    def relation(obj_vecs, pred_vecs, s_idx, o_idx, z):
+        return model.pos_relation(obj_vecs, pred_vecs, s_idx, o_idx, z=z, training=False)['pred_cls']
+
+    @tf.function(input_signature=[vec_spec(64), vec_spec(64), idx_spec, idx_spec])
+    def generation_encoder(obj_vecs, pred_vecs, s_idx, o_idx):
+        return model.generation.g_enc(obj_vecs, pred_vecs, tf.stack([s_idx, o_idx], axis=1), training=False)
+
+    @tf.function(input_signature=[
+        vec_spec(128), vec_spec(128), idx_spec, idx_spec, vec_spec(4), idx_spec, idx_spec, vec_spec(1), vec_spec(32)])
+    def generation_step(new_obj_vecs, new_pred_vecs, s_idx, o_idx, previous_bb, obj_layout, pred_layout, c_k_counts, eps):
+        return model.generation.decode_step(
+            new_obj_vecs, new_pred_vecs, tf.stack([s_idx, o_idx], axis=1),
+            previous_bb, obj_layout, pred_layout, c_k_counts, eps=eps)
+
+    @tf.function(input_signature=[vec_spec(64), vec_spec(64), vec_spec(4), idx_spec, idx_spec])
+    def refinement(obj_vecs, pred_vecs, pred_boxes, s_idx, o_idx):
+        return model.refinement(obj_vecs, pred_vecs, pred_boxes, s_idx, o_idx, training=False)['bb_predicted']
+
+    return {
+        'relation': relation,
+        'generation_encoder': generation_encoder,
+        'generation_step': generation_step,
+        'refinement': refinement
+    }
+
+
+def embedding_tables(model):
+    """
+    Returns:
+        obj_embedding: (num categories, 64)
+        pos_pred_embedding: (num relations, 64)
+    """
+    # looking up every index also builds the embeddings, which restores their weights
+    return (
+        model.obj_embedding(tf.range(len(model.vocab['object_name_to_idx'])), training=False).numpy(),
+        model.pos_pred_embedding(tf.range(len(model.vocab['pos_pred_name_to_idx'])), training=False).numpy()
+    )
+
+
+def export_lite(model, output_dir, quantization='float16'):
+    """convert relation, generation and refinement of a restored model into TFLite
+
+    float16 stores the weights as float16, int8 quantizes the weights to int8
+    and runs the matmuls with dynamic range quantization, ops without a TFLite
+    kernel fall back to TensorFlow ops. embedding tables and vocab are saved as
+    they are, see LitePipeline.load
+
+    Args:
+        model: NeuralDesignNetwork, with the weights of a checkpoint
+        output_dir: directory of <name>.tflite, embeddings and vocab
+        quantization: one of QUANTIZATIONS
+
+    Returns:
+        sizes: dict, size in bytes of every TFLite model
+    """
+    assert quantization in QUANTIZATIONS, 'Invalid quantization "%s"' % quantization
+
+    sizes = {}
+    for name, function in build_lite_functions(model).items():
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()])
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+        if quantization != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+
+        lite_model = converter.convert()
+        with open(os.path.join(output_dir, name + '.tflite'), 'wb') as f:
+            f.write(lite_model)
+        sizes[name] = len(lite_model)
+
+    obj_embedding, pos_pred_embedding = embedding_tables(model)
+    np.save(os.path.join(output_dir, 'obj_embedding.npy'), obj_embedding)
+    np.save(os.path.join(output_dir, 'pos_pred_embedding.npy'), pos_pred_embedding)
+
+    with open(os.path.join(output_dir, 'vocab.json'), 'w') as f:
+        json.dump(model.vocab, f)
+
+    return sizes
+
+
+class LiteRunner:
+    """run a TFLite model on inputs of any size
+
+    inputs are given in the order of the signature of build_lite_functions,
+    outputs are returned as a list
+    """
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.input_shapes = None
+
+    def __call__(self, *inputs):
+        input_shapes = [np.shape(x) for x in inputs]
+
+        # the tensors are only reallocated when the graph size changes
+        if input_shapes != self.input_shapes:
+            for detail, shape in zip(self.input_details, input_shapes):
+                self.interpreter.resize_tensor_input(detail['index'], shape)
+            self.interpreter.allocate_tensors()
+            self.input_shapes = input_shapes
+
+        for detail, x in zip(self.input_details, inputs):
+            self.interpreter.set_tensor(detail['index'], np.asarray(x, dtype=detail['dtype']))
+
+        self.interpreter.invoke()
+
+        return [self.interpreter.get_tensor(detail['index']) for detail in self.output_details]
+
+
+class FunctionRunner:
+    """run a function of build_lite_functions like LiteRunner, as the reference of drift"""
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *inputs):
+        return [x.numpy() for x in tf.nest.flatten(self.function(*inputs))]
+
+
+class LitePipeline:
+    """relation completion, generation and refinement with numpy and runners
+
+    Args:
+        runners: dict of LiteRunner or FunctionRunner, keyed by LITE_MODELS
+        obj_embedding: (num categories, 64)
+        pos_pred_embedding: (num relations, 64)
+        vocab: vocab of NeuralDesignNetwork
+    """
+    def __init__(self, runners, obj_embedding, pos_pred_embedding, vocab):
+        self.runners = runners
+        self.obj_embedding = obj_embedding
+        self.pos_pred_embedding = pos_pred_embedding
+        self.vocab = vocab
+
+    @classmethod
+    def load(cls, lite_dir, num_threads=None):
+        """load the output of export_lite"""
+        with open(os.path.join(lite_dir, 'vocab.json')) as f:
+            vocab = json.load(f)
+
+        return cls(
+            {name: LiteRunner(os.path.join(lite_dir, name + '.tflite'), num_threads=num_threads) for name in LITE_MODELS},
+            np.load(os.path.join(lite_dir, 'obj_embedding.npy')),
+            np.load(os.path.join(lite_dir, 'pos_pred_embedding.npy')),
+            vocab
+        )
+
+    @staticmethod
+    def sample_noise(objs, rng=np.random):
+        """noise of one run on the batched graph objs
+
+        Returns:
+            noise: dict, z (O, 32) of relation, eps (K, L, 32) of every decoding step
+        """
+        layout_sizes = np.diff(np.concatenate([[-1], np.nonzero(objs == 0)[0]]))
+
+        return {
+            'z': rng.standard_normal((len(objs), 32)).astype(np.float32),
+            'eps': rng.standard_normal((layout_sizes.max(), len(layout_sizes), 32)).astype(np.float32)
+        }
+
+    def __call__(self, objs, pos_triples, noise):
+        """
+        Args:
+            objs: (O, ) batched graph, every layout ends with __image__ item
+            pos_triples: (T, 3), 'unknown' relations are predicted
+            noise: dict, see sample_noise
+
+        Returns:
+            result: dict, pred_cls (T, C), pos_pred (T, ), pred_boxes and pred_boxes_refine (O, 4)
+        """
+        result = {}
+
+        objs = np.asarray(objs, dtype=np.int32)
+        s, pos_pred, o = [np.asarray(x, dtype=np.int32) for x in np.asarray(pos_triples).T]
+        obj_vecs = self.obj_embedding[objs]
+
+        # relation completion, see NeuralDesignNetwork.complete_relations
+        pred_cls, = self.runners['relation'](obj_vecs, self.pos_pred_embedding[pos_pred], s, o, noise['z'])
+        unknown = len(self.vocab['pos_pred_name_to_idx']) - 1
+        new_p = np.argmax(pred_cls[:, 1:unknown], axis=-1).astype(np.int32) + 1
+        pos_pred = np.where(pos_pred == unknown, new_p, pos_pred)
+        pos_pred_vecs = self.pos_pred_embedding[pos_pred]
+        result['pred_cls'] = pred_cls
+        result['pos_pred'] = pos_pred
+
+        # generation, see NDNGeneration.decode_batched
+        new_obj_vecs, new_pred_vecs = self.runners['generation_encoder'](obj_vecs, pos_pred_vecs, s, o)
+
+        image_idx = np.nonzero(objs == 0)[0]
+        layout_sizes = np.diff(np.concatenate([[-1], image_idx]))
+        obj_offsets = image_idx + 1 - layout_sizes
+        obj_layout = np.repeat(np.arange(len(layout_sizes), dtype=np.int32), layout_sizes)
+        pred_layout = obj_layout[s]
+        c_k_counts = (layout_sizes + (layout_sizes - 1) ** 2).reshape(-1, 1).astype(np.float32)
+
+        previous_bb = np.zeros((len(objs), 4), dtype=np.float32)
+        pred_boxes = np.zeros((len(objs), 4), dtype=np.float32)
+
+        for k in range(layout_sizes.max()):
+            bb_k_predicted, = self.runners['generation_step'](
+                new_obj_vecs, new_pred_vecs, s, o, previous_bb, obj_layout, pred_layout, c_k_counts, noise['eps'][k])
+
+            # only layouts with more than k elements are still decoding
+            decoding = k < layout_sizes
+            k_idx = (obj_offsets + k)[decoding]
+            pred_boxes[k_idx] = bb_k_predicted[decoding]
+            # for __image__ item, use gt bbox
+            previous_bb[k_idx] = np.where((objs[k_idx] == 0)[:, None], IMAGE_BB, bb_k_predicted[decoding])
+
+        result['pred_boxes'] = pred_boxes
+
+        result['pred_boxes_refine'], = self.runners['refinement'](obj_vecs, pos_pred_vecs, pred_boxes, s, o)
+
+        return result
+
+
+def lite_drift(model, lite_dir, dataset, num_batches=10, seed=0):
+    """compare the TFLite models of lite_dir with the original ones of model
+
+    both run on the same batches with the same noise, so the difference
+    only comes from conversion and quantization. relations are completed from
+    the gt relations with mask_rate of them unknown
+
+    Args:
+        model: NeuralDesignNetwork, with the weights exported to lite_dir
+        lite_dir: output of export_lite
+        dataset: dataset of (objs, boxes, pos_triples), e.g. build_layout_dataset
+        num_batches: number of batches compared
+        seed: seed of masking and noise
+
+    Returns:
+        drift: dict
+            relation_agreement: ratio of completed relations that agree
+            boxes_drift, boxes_refine_drift: mean L1 distance between the boxes of both
+            recon_loss, recon_loss_lite: L1 error of refined boxes to gt
+    """
+    reference = LitePipeline(
+        {name: FunctionRunner(function) for name, function in build_lite_functions(model).items()},
+        *embedding_tables(model),
+        model.vocab
+    )
+    lite = LitePipeline.load(lite_dir)
+
+    rng = np.random.RandomState(seed)
+    unknown = len(model.vocab['pos_pred_name_to_idx']) - 1
+    metrics = {name: [] for name in ['relation_agreement', 'boxes_drift', 'boxes_refine_drift', 'recon_loss', 'recon_loss_lite']}
+
+    for objs, boxes, pos_triples in dataset.take(num_batches):
+        objs, boxes, pos_triples = objs.numpy(), boxes.numpy(), pos_triples.numpy()
+
+        # mask relations to complete, __in_image__ is never masked
+        masked = (pos_triples[:, 1] != 0) & (rng.random_sample(len(pos_triples)) <= model.config.get('mask_rate', .5))
+        pos_triples[masked, 1] = unknown
+
+        noise = LitePipeline.sample_noise(objs, rng)
+        result = reference(objs, pos_triples, noise)
+        result_lite = lite(objs, pos_triples, noise)
+
+        metrics['relation_agreement'].append(np.mean(result['pos_pred'][masked] == result_lite['pos_pred'][masked]) if masked.any() else 1.)
+        metrics['boxes_drift'].append(np.mean(np.abs(result['pred_boxes'] - result_lite['pred_boxes'])))
+        metrics['boxes_refine_drift'].append(np.mean(np.abs(result['pred_boxes_refine'] - result_lite['pred_boxes_refine'])))
+        metrics['recon_loss'].append(np.mean(np.abs(result['pred_boxes_refine'] - boxes)))
+        metrics['recon_loss_lite'].append(np.mean(np.abs(result_lite['pred_boxes_refine'] - boxes)))
+
+    return {name: float(np.mean(values)) for name, values in metrics.items()}
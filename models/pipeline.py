@@ -1,25 +1,68 @@
-from uuid import NAMESPACE_X500
-from models.refinement import NDNRefinement
 import tensorflow as tf
 from tensorflow import keras
 
-import tensorflow_probability as tfp
-
 from models.relation import NDNRelation
 from models.generation import NDNGeneration
+from models.graph import layout_offsets, tile_edges
 from models.refinement import NDNRefinement
+from models.classifier import LayoutClassifier
+from models.render import Renderer, rasterize, contact_sheet
+from models.schedule import Schedule
+from models.checkpoint import AsyncCheckpointer
+from models.distributed import worker_info
+from models.profiling import StageTimer, TraceWindow
+from models.data import build_vocab, build_layout_dataset, build_design_graph, concat_graphs, save_layout
 
 import os
+import glob
 import json
-import math
-import random
-from PIL import Image, ImageDraw
+import time
+import collections
+import numpy as np
+from functools import partial
+
+
+MODULES = ['relation', 'generation', 'refinement', 'classifier']
+
+
+def required_modules(mode, part=None, rerank=False):
+    """modules NeuralDesignNetwork needs for a mode of main.py
+
+    Args:
+        mode: one of train, test, evaluate, generate, export
+        part: part trained or tested, relation or generation
+        rerank: generate reranks candidates with classifier
+
+    Returns:
+        modules: list of names in MODULES
+    """
+    assert mode in ['train', 'test', 'evaluate', 'generate', 'export'], 'Invalid mode "%s"' % mode
+
+    if mode in ['train', 'test', 'evaluate'] and part == 'relation':
+        return ['relation']
+
+    if mode in ['train', 'evaluate'] and part == 'generation':
+        return ['generation', 'refinement']
+
+    # generation is tested and generates with the relations predicted by relation
+    modules = ['relation', 'generation', 'refinement']
+
+    if mode == 'generate' and rerank:
+        modules.append('classifier')
+
+    return modules
 
 
 class NeuralDesignNetwork:
-    def __init__(self, category_list, pos_relation_list, size_relation_list, config, save=False, training=True):
+    def __init__(self, category_list, pos_relation_list, size_relation_list, config, save=False, training=True, strategy=None, modules=None):
         super(NeuralDesignNetwork, self).__init__()
 
+        # data-parallel training, every worker runs the steps on its own batches
+        # and the gradients are all-reduced, see models.distributed
+        self.strategy = strategy or tf.distribute.get_strategy()
+        self.num_workers, self.worker_index = worker_info(self.strategy)
+        self.is_chief = self.worker_index == 0
+
         self.save = save
         self.training = training
         self.config = config
@@ -28,42 +71,64 @@ class NeuralDesignNetwork:
         self.size_relation_list = size_relation_list
 
         # construct vocab
-        self.vocab = {
-            'object_name_to_idx': {},
-            'pos_pred_name_to_idx': {},
-            # 'size_pred_name_to_idx': {}
-        }
-
-        self.vocab['object_name_to_idx']['__image__'] = 0
-        self.vocab['pos_pred_name_to_idx']['__in_image__'] = 0
-        # self.vocab['size_pred_name_to_idx']['__in_image__'] = 0
-
-        for idx, item in enumerate(category_list):
-            self.vocab['object_name_to_idx'][item] = idx + 1
-        
-        for idx, item in enumerate(pos_relation_list):
-            self.vocab['pos_pred_name_to_idx'][item] = idx + 1
-        
-        # for idx, item in enumerate(size_relation_list):
-        #     self.vocab['size_pred_name_to_idx'][item] = idx + 1
-
-        # build GCN as described in supplementary material
-        self.pos_relation = NDNRelation(category_list=self.vocab['object_name_to_idx'].keys(), relation_list=self.vocab['pos_pred_name_to_idx'].keys())
-        # self.size_relation = NDNRelation(category_list=self.vocab['object_name_to_idx'].keys(), relation_list=self.vocab['size_pred_name_to_idx'])
-
-        self.generation = NDNGeneration()
-        self.refinement = NDNRefinement()
-
-        self.obj_embedding = keras.layers.Embedding(input_dim=len(self.vocab['object_name_to_idx']), output_dim=64)
-        self.pos_pred_embedding = keras.layers.Embedding(input_dim=len(self.vocab['pos_pred_name_to_idx']), output_dim=64)
-        # self.size_pred_embedding = keras.layers.Embedding(input_dim=len(self.vocab['size_pred_name_to_idx']), output_dim=64)
-        # define optimizer
-        self.relation_optimizer = keras.optimizers.Adam(learning_rate=config['learning_rate'], beta_1=config['beta_1'], beta_2=config['beta_2'])
-        self.generation_optimizer = keras.optimizers.Adam(learning_rate=config['learning_rate'], beta_1=config['beta_1'], beta_2=config['beta_2'])
-        self.refinement_optimizer = keras.optimizers.Adam(learning_rate=config['learning_rate'], beta_1=config['beta_1'], beta_2=config['beta_2'])
-
-        # define ckpt manger
-        self.ckpt = tf.train.Checkpoint(
+        self.vocab = build_vocab(category_list, pos_relation_list)
+
+        # only the modules of the mode are built, the others are None, see required_modules
+        self.modules = MODULES if modules is None else modules
+
+        # modules whose GCN runs on padded layouts, see GraphTripleConvStack
+        for name in self.modules + config.get('dense_gcn', []) + config.get('recompute_grad', []):
+            assert name in MODULES, 'Invalid module "%s"' % name
+        gcn_engine = lambda name: 'dense' if name in config.get('dense_gcn', []) else 'sparse'
+        # modules whose GCN layers recompute their activations in the backward pass to save memory
+        gcn_recompute = lambda name: name in config.get('recompute_grad', [])
+        # the first layer of the triple mlp projects every node once, same weights either way
+        gcn_factorized = config.get('factorized_gcn', True)
+
+        self.pos_relation = self.generation = self.refinement = self.classifier = None
+        self.relation_optimizer = self.generation_optimizer = self.refinement_optimizer = None
+
+        # variables are mirrored on all the workers
+        with self.strategy.scope():
+            # build GCN as described in supplementary material
+            if 'relation' in self.modules:
+                self.pos_relation = NDNRelation(category_list=self.vocab['object_name_to_idx'].keys(), relation_list=self.vocab['pos_pred_name_to_idx'].keys(), gcn_engine=gcn_engine('relation'), gcn_factorized=gcn_factorized,
+                    gcn_recompute=gcn_recompute('relation'))
+            # self.size_relation = NDNRelation(category_list=self.vocab['object_name_to_idx'].keys(), relation_list=self.vocab['size_pred_name_to_idx'])
+
+            if 'generation' in self.modules:
+                self.generation = NDNGeneration(
+                    decode_mode=config.get('decode_mode', 'batched'),
+                    teacher_forcing=config.get('teacher_forcing', 'sequential'),
+                    gcn_engine=gcn_engine('generation'),
+                    gcn_factorized=gcn_factorized,
+                    gcn_recompute=gcn_recompute('generation'))
+            if 'refinement' in self.modules:
+                self.refinement = NDNRefinement(
+                    gcn_engine=gcn_engine('refinement'), gcn_factorized=gcn_factorized, gcn_recompute=gcn_recompute('refinement'))
+            # reranks generated candidates, index 1 of its score is the probability of a real layout
+            if 'classifier' in self.modules:
+                self.classifier = LayoutClassifier(
+                    gcn_engine=gcn_engine('classifier'), gcn_factorized=gcn_factorized, gcn_recompute=gcn_recompute('classifier'))
+
+            self.obj_embedding = keras.layers.Embedding(input_dim=len(self.vocab['object_name_to_idx']), output_dim=64)
+            self.pos_pred_embedding = keras.layers.Embedding(input_dim=len(self.vocab['pos_pred_name_to_idx']), output_dim=64)
+            # self.size_pred_embedding = keras.layers.Embedding(input_dim=len(self.vocab['size_pred_name_to_idx']), output_dim=64)
+            # define optimizer, only to train
+            build_optimizer = lambda: keras.optimizers.Adam(learning_rate=config['learning_rate'], beta_1=config['beta_1'], beta_2=config['beta_2'])
+            if training and self.pos_relation is not None:
+                self.relation_optimizer = build_optimizer()
+            if training and self.generation is not None:
+                self.generation_optimizer = build_optimizer()
+            if training and self.refinement is not None:
+                self.refinement_optimizer = build_optimizer()
+
+            # training step of the checkpoint
+            self.global_step = tf.Variable(0, trainable=False, dtype=tf.int64)
+
+        # define ckpt manger, with the modules that are built
+        checkpointables = dict(
+            global_step=self.global_step,
             obj_embedding=self.obj_embedding,
             pos_pred_embedding=self.pos_pred_embedding,
             # size_pred_embedding=self.size_pred_embedding,
@@ -75,10 +140,28 @@ class NeuralDesignNetwork:
             generation_optimizer=self.generation_optimizer,
             refinement_optimizer=self.refinement_optimizer
         )
+        self.ckpt = tf.train.Checkpoint(**{name: value for name, value in checkpointables.items() if value is not None})
+
+        # classifier is not trained with the other modules, its weights come from its own checkpoint
+        self.classifier_ckpt = tf.train.Checkpoint(classifier=self.classifier) if self.classifier is not None else None
+        self.classifier_restored = False
+        self.restored_objects = set()
 
         # define training parameters
         self.iter_cnt = 0
 
+        # wall time of the stages of every training step
+        self.timer = StageTimer(enabled=config.get('profile_stages', False))
+
+        # sample images are drawn in background processes
+        self.renderer = Renderer(
+            num_workers=config.get('render_workers', 2),
+            max_pending=config.get('render_max_pending', 32))
+
+        # number of times every compiled step has been traced
+        self.trace_count = collections.Counter()
+        self.steps = self.build_steps()
+
     @staticmethod
     def KL_divergence(mu, var, mu_prior, var_prior):
         mu = tf.concat(mu, axis=0)
@@ -106,12 +189,29 @@ class NeuralDesignNetwork:
         # KL loss can be calculated according to mu and var
         KL_loss = self.KL_divergence(mu, var, mu_prior, var_prior)
 
-        return self.config['lambda_recon'] * recon_loss * bb_gt.shape[0] + self.config['lambda_kl_1'] * KL_loss
+        num_boxes = tf.cast(tf.shape(bb_gt)[0], recon_loss.dtype)
+
+        return self.config['lambda_recon'] * recon_loss * num_boxes + self.config['lambda_kl_1'] * KL_loss
 
     def refinement_loss(self, bb_gt, bb_predicted):
         recon_loss = tf.keras.losses.MeanAbsoluteError()(bb_gt, bb_predicted)
 
-        return recon_loss * bb_gt.shape[0] # return the sum, not mean
+        num_boxes = tf.cast(tf.shape(bb_gt)[0], recon_loss.dtype)
+
+        return recon_loss * num_boxes # return the sum, not mean
+
+    @staticmethod
+    def split_layouts(objs, *arrays):
+        """split numpy arrays of a batched graph into layouts
+
+        every layout ends with __image__ item
+
+        Returns:
+            layouts: list of (objs, *arrays) of every layout
+        """
+        ends = np.nonzero(objs == 0)[0] + 1
+
+        return list(zip(*[np.split(a, ends[:-1]) for a in (objs,) + arrays]))
 
     @staticmethod
     def split_graph(objs, triples):
@@ -122,194 +222,712 @@ class NeuralDesignNetwork:
 
         return s, p, o
 
+    def build_steps(self):
+        """build the step functions of every part
 
-    def fetch_one_data(self, dataset):
-        """[summary]
+        if `compile_steps` is set, every step is wrapped into a tf.function.
+        objs, boxes and triples of a batch are concatenated along the first axis,
+        so the signatures leave it unknown and a new layout size does not retrace
+
+        Returns:
+            steps: dict of step functions
+        """
+        objs_spec = tf.TensorSpec(shape=(None,), dtype=tf.int32)
+        boxes_spec = tf.TensorSpec(shape=(None, 4), dtype=tf.float32)
+        triples_spec = tf.TensorSpec(shape=(None, 3), dtype=tf.int32)
+        step_spec = tf.TensorSpec(shape=(), dtype=tf.int64)
+        num_samples_spec = tf.TensorSpec(shape=(), dtype=tf.int32)
+        candidate_triples_spec = tf.TensorSpec(shape=(None, None, 3), dtype=tf.int32)
+        candidate_boxes_spec = tf.TensorSpec(shape=(None, None, 4), dtype=tf.float32)
+
+        signatures = {
+            'relation_train': (self.relation_train_step, [objs_spec, triples_spec, step_spec]),
+            'relation_eval': (self.relation_eval_step, [objs_spec, triples_spec]),
+            'generation_train': (self.generation_train_step, [objs_spec, boxes_spec, triples_spec]),
+            'generation_eval': (self.generation_eval_step, [objs_spec, boxes_spec, triples_spec]),
+            'refinement_train': (self.refinement_train_step, [objs_spec, boxes_spec, triples_spec]),
+            'refinement_eval': (self.refinement_eval_step, [objs_spec, boxes_spec, triples_spec]),
+            'sample_candidates': (
+                partial(self.sample_candidates_step, sample_relations=False), [objs_spec, triples_spec, num_samples_spec]),
+            'sample_candidates_relations': (
+                partial(self.sample_candidates_step, sample_relations=True), [objs_spec, triples_spec, num_samples_spec]),
+            'rerank': (self.rerank_step, [objs_spec, candidate_triples_spec, candidate_boxes_spec]),
+            'inference': (self.inference_step, [objs_spec, triples_spec]),
+        }
+
+        steps = {}
+        for name, (step_fn, input_signature) in signatures.items():
+            step_fn = self.distribute(step_fn)
+
+            if self.config.get('compile_steps', True):
+                steps[name] = self.count_traces(name, tf.function(step_fn, input_signature=input_signature))
+            else:
+                steps[name] = step_fn
+
+        return steps
+
+    def count_traces(self, name, step):
+        """count the traces of the compiled step in self.trace_count[name]
+
+        the first call traces twice when the step creates variables, so the
+        traces of the first call count as one and every later trace is a retrace
 
         Args:
-            dataset ([type]): [description]
-        
+            name: name of the step
+            step: tf.function
+        """
+        def counted_step(*args):
+            first_call = name not in self.trace_count
+            tracing_count = step.experimental_get_tracing_count()
+
+            result = step(*args)
+
+            new_traces = step.experimental_get_tracing_count() - tracing_count
+            if first_call:
+                self.trace_count[name] = 1
+            elif new_traces:
+                self.trace_count[name] += new_traces
+                print('Step %s retraced, %d traces in total.' % (name, self.trace_count[name]))
+
+            return result
+
+        return counted_step
+
+    def distribute(self, step_fn):
+        """run step_fn on the replica of this worker
+
+        inside a train step, apply_gradients sums the gradients of all the workers.
+        every worker has one replica, its results are returned as they are
+        """
+        def distributed_step_fn(*args):
+            result = self.strategy.run(step_fn, args=args)
+
+            return tf.nest.map_structure(lambda x: self.strategy.experimental_local_results(x)[0], result)
+
+        return distributed_step_fn
+
+    def mask_relations(self, pos_pred, step):
+        """randomly replace relations by 'unknown' to generate training data
+
+        every relation but __in_image__ is masked with probability mask_rate.
+        the mask only depends on mask_seed and step, so a run can be reproduced
+
+        Args:
+            pos_pred: (T, )
+            step: training step
+
         Returns:
-            objs (): 
-            pos_triples ():
-            size_triples ():
+            pos_pred: (T, ) masked relations
         """
-        batch_json = dataset.take(1).as_numpy_iterator()
-
-        for item in batch_json:
-            batch_data = item
-
-        '''
-        combine the objects in one batch into a big graph
-        '''
-        obj_offset = 0
-        all_obj = []
-        all_boxes = []
-
-        layout_height = 64.
-        layout_width = 64.
-
-        # triple: [s, p, o]
-        # s: index in all_obj
-        # p: index of relationship
-        # o: index in all_obj
-        all_pos_triples = []
-        # all_size_triples = []
-
-        for item in batch_data:
-            layout = json.load(open(item))
-            cur_obj = []
-            cur_boxes = []
-            for category in layout.keys():
-                for obj in layout[category]:
-                    all_obj.append(self.vocab['object_name_to_idx'][category])
-                    cur_obj.append(all_obj[-1])
-
-                    x0, y0, x1, y1 = obj
-                    x0 /= layout_width
-                    y0 /= layout_height
-                    x1 /= layout_width
-                    y1 /= layout_height
-                    w = x1 - x0
-                    h = y1 - y0
-                    all_boxes.append(tf.convert_to_tensor([x0, y0, w, h], dtype=tf.float32))
-                    cur_boxes.append(all_boxes[-1])
-            
-            # at the end of one layout add __image__ item
-            all_obj.append(self.vocab['object_name_to_idx']['__image__'])
-            cur_obj.append(all_obj[-1])
-            all_boxes.append(tf.convert_to_tensor([0, 0, 1, 1], dtype=tf.float32))
-            cur_boxes.append(all_boxes[-1])
-
-            # compute centers of layout in current layout
-            obj_centers = []
-            for box in cur_boxes:
-                x0, y0, w, h = box
-                x1, y1 = x0 + w, y1 + h
-                obj_centers.append([(x0 + x1) / 2, (y0 + y1) / 2])
-
-            # calculate triples
-            whole_image_idx = self.vocab['object_name_to_idx']['__image__']
-            for obj_index, obj in enumerate(cur_obj):
-                if obj == whole_image_idx:
-                    continue
-
-                # create a complete graph
-                other_obj = [obj_idx for obj_idx, obj in enumerate(cur_obj) if (
-                    obj_idx != obj_index and obj != whole_image_idx)]
-                
-                if len(other_obj) == 0:
-                    continue
-
-                for other in other_obj:
-                    s = obj_index
-                    o = other
-
-                    # sx0, sy0, sx1, sy1 = cur_boxes[s]
-                    # ox0, oy0, ox1, oy1 = cur_boxes[o]
-                    sx0, sy0, sw, sh = cur_boxes[s]
-                    ox0, oy0, ow, oh = cur_boxes[o]
-
-                    sx1, sy1 = sx0 + sw, sy0 + sh
-                    ox1, oy1 = ox0 + ow, oy0 + oh
-
-                    d0 = obj_centers[s][0] - obj_centers[o][0]
-                    d1 = obj_centers[s][1] - obj_centers[o][1]
-                    theta = math.atan2(d1, d0)
-
-                    # calculate position relationship
-                    # now we have 6 kinds of position relationship
-                    if sx0 < ox0 and sx1 > ox1 and sy0 < oy0 and sy1 > oy1:
-                        p = 'surrounding'
-                    elif sx0 > ox0 and sx1 < ox1 and sy0 > oy0 and sy1 < oy1:
-                        p = 'inside'
-                    elif theta >= 3 * math.pi / 4 or theta <= -3 * math.pi / 4:
-                        p = 'left of'
-                    elif -3 * math.pi / 4 <= theta < -math.pi / 4:
-                        p = 'above'
-                    elif -math.pi / 4 <= theta < math.pi / 4:
-                        p = 'right of'
-                    elif math.pi / 4 <= theta < 3 * math.pi / 4:
-                        p = 'below'
-                    p = self.vocab['pos_pred_name_to_idx'][p]
-
-                    all_pos_triples.append([s + obj_offset, p, o + obj_offset])
-
-                    # calculate size relationship
-                    # now we have 3 kinds of size relationship
-                    # if sw > ow and sh > oh:
-                    #     p = 'bigger'
-                    # elif sw < ow and sh < oh:
-                    #     p = 'smaller'
-                    # elif sw * sh > ow * oh:
-                    #     p = 'bigger'
-                    # elif sw * sh < ow * oh:
-                    #     p = 'smaller'
-                    # else:
-                    #     p = 'same'
-                    # p = self.vocab['size_pred_name_to_idx'][p]
-                    # all_size_triples.append([s + obj_offset, p, o + obj_offset])
-
-            # add __in_image__ triples
-            O = len(cur_obj)
-            pos_in_image = self.vocab['pos_pred_name_to_idx']['__in_image__']
-            # size_in_image = self.vocab['size_pred_name_to_idx']['__in_image__']
-            for i in range(O - 1):
-                all_pos_triples.append([i + obj_offset, pos_in_image, O - 1 + obj_offset])
-                # all_size_triples.append([i + obj_offset, size_in_image, O - 1 + obj_offset])
-
-            obj_offset += len(cur_obj)
-        
-        all_obj = tf.convert_to_tensor(all_obj)
-        all_boxes = tf.convert_to_tensor(all_boxes)
-        all_pos_triples = tf.convert_to_tensor(all_pos_triples)
-        # all_size_triples = tf.convert_to_tensor(all_size_triples)
-            
-        # return all_obj, all_boxes, all_pos_triples, all_size_triples
-        return all_obj, all_boxes, all_pos_triples
+        unknown = len(self.vocab['pos_pred_name_to_idx']) - 1
+        seed = tf.stack([tf.constant(self.config.get('mask_seed', 0), dtype=tf.int64), step])
+
+        masked = tf.logical_and(
+            tf.not_equal(pos_pred, 0),
+            tf.random.stateless_uniform(tf.shape(pos_pred), seed=seed) <= self.config['mask_rate'])
+
+        return tf.where(masked, unknown, pos_pred)
+
+    def relation_train_step(self, objs, pos_triples_gt, step):
+        step_result = {}
+
+        s, pos_pred_gt, o = self.split_graph(objs, pos_triples_gt)
+        pos_pred = self.mask_relations(pos_pred_gt, step)
+
+        with tf.GradientTape() as tape:
+            # get embedding of obj and pred
+            obj_vecs = self.obj_embedding(objs, training=True)
+            pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
+            pred_gt_vecs = self.pos_pred_embedding(pos_pred_gt, training=True)
+
+            result = self.pos_relation(obj_vecs, pred_gt_vecs, s, o, pred_vecs=pred_vecs, training=True)
+
+            # embedding pred with one_hot, to calculate cross entropy loss
+            pred_gt_one_hot = tf.one_hot(pos_pred_gt, depth=len(self.vocab['pos_pred_name_to_idx']))
+            step_result['gt_pos_cls'] = pred_gt_one_hot
+            # get latent variable of G_gt
+            # z = tf.concat([result['obj_vecs_with_gt'], result['pred_vecs_with_gt']], axis=0)
+            pos_loss = self.relation_loss(pred_gt_one_hot, result['pred_cls'], result['z_mu'], result['z_var'])
+            step_result['pos_loss'] = pos_loss
+            step_result['pred_pos_cls'] = result['pred_cls']
+
+            # gradients are summed over the workers
+            scaled_loss = pos_loss / self.strategy.num_replicas_in_sync
+
+        train_var = self.pos_relation.trainable_variables \
+                    + self.obj_embedding.trainable_variables + self.pos_pred_embedding.trainable_variables
+        gradients = tape.gradient(scaled_loss, train_var)
+
+        self.relation_optimizer.apply_gradients(
+            zip(gradients, train_var)
+        )
+
+        return step_result
+
+    def relation_eval_step(self, objs, pos_triples_gt):
+        step_result = {}
+
+        s, pos_pred_gt, o = self.split_graph(objs, pos_triples_gt)
+        pos_pred = tf.ones_like(pos_pred_gt) * (len(self.vocab['pos_pred_name_to_idx']) - 1)
+
+        obj_vecs = self.obj_embedding(objs, training=False)
+
+        pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+        result = self.pos_relation(obj_vecs, pred_vecs, s, o, training=False)
+        pred_gt_one_hot = tf.one_hot(pos_pred_gt, depth=len(self.vocab['pos_pred_name_to_idx']))
+        step_result['gt_pos_cls'] = pred_gt_one_hot
+        step_result['pred_pos_cls'] = result['pred_cls']
+
+        return step_result
+
+    def complete_relations(self, pos_pred, pred_cls):
+        """replace 'unknown' relations by the predicted ones
+
+        'unknown' is only replaced by one of the position relationships,
+        __in_image__ is the first and unknown is the last relation
+        """
+        unknown = len(self.vocab['pos_pred_name_to_idx']) - 1
+        new_p = tf.cast(tf.math.argmax(pred_cls[..., 1:unknown], axis=-1), pos_pred.dtype) + 1
+
+        return tf.where(tf.equal(pos_pred, unknown), new_p, pos_pred)
+
+    def inference_step(self, objs, pos_triples):
+        """relation completion, generation and refinement in one step
+
+        embeddings are computed once, 'unknown' relations are replaced by the predicted ones,
+        which are used by generation and refinement
+
+        Args:
+            objs: (O, )
+            pos_triples: (T, 3)
+
+        Returns:
+            step_result: dict, pred_pos_cls (T, C), pos_triples (T, 3) with completed relations,
+                pred_boxes and pred_boxes_refine (O, 4)
+        """
+        step_result = {}
+
+        s, pos_pred, o = self.split_graph(objs, pos_triples)
+
+        obj_vecs = self.obj_embedding(objs, training=False)
+        pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+
+        result = self.pos_relation(obj_vecs, pred_vecs, s, o, training=False)
+        step_result['pred_pos_cls'] = result['pred_cls']
+
+        pos_pred = self.complete_relations(pos_pred, result['pred_cls'])
+        pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+        step_result['pos_triples'] = tf.stack([s, pos_pred, o], axis=1)
+
+        # boxes are not used when not training
+        result = self.generation(objs, obj_vecs, pos_pred_vecs, tf.zeros((tf.shape(objs)[0], 4)), s, o, training=False)
+        step_result['pred_boxes'] = result['pred_boxes']
+
+        result = self.refinement(obj_vecs, pos_pred_vecs, result['pred_boxes'], s, o, training=False)
+        step_result['pred_boxes_refine'] = result['bb_predicted']
+
+        return step_result
+
+    def sample_candidates_step(self, objs, pos_triples, num_samples, sample_relations=False):
+        """generate num_samples candidate layouts for every layout of the graph
+
+        embeddings and, unless sample_relations, the relation completion and g_enc
+        of generation run once. the candidates are decoded and refined in parallel
+        as disjoint copies of the graph
+
+        Args:
+            objs: (O, )
+            pos_triples: (T, 3), 'unknown' relations are predicted
+            num_samples: M
+            sample_relations: predict the relations of every candidate with its own z
+
+        Returns:
+            step_result: dict, pred_boxes and pred_boxes_refine (M, O, 4), pos_triples (M, T, 3)
+        """
+        step_result = {}
+
+        O = tf.shape(objs)[0]
+        s, pos_pred, o = self.split_graph(objs, pos_triples)
+        tiled_objs = tf.tile(objs, [num_samples])
+        tiled_s, tiled_o = tile_edges(s, o, O, num_samples)
+
+        obj_vecs = self.obj_embedding(objs, training=False)
+        pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+        tiled_obj_vecs = tf.tile(obj_vecs, [num_samples, 1])
+
+        if sample_relations:
+            result = self.pos_relation.sample(obj_vecs, pred_vecs, s, o, num_samples)
+            # (M * T, )
+            pos_pred = tf.reshape(self.complete_relations(pos_pred, result['pred_cls']), (-1,))
+            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+
+            result = self.generation(tiled_objs, tiled_obj_vecs, pos_pred_vecs, tf.zeros((num_samples * O, 4)), tiled_s, tiled_o, training=False)
+        else:
+            result = self.pos_relation(obj_vecs, pred_vecs, s, o, training=False)
+            pos_pred = self.complete_relations(pos_pred, result['pred_cls'])
+            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+
+            result = self.generation.sample(objs, obj_vecs, pos_pred_vecs, s, o, num_samples)
+
+            pos_pred = tf.tile(pos_pred, [num_samples])
+            pos_pred_vecs = tf.tile(pos_pred_vecs, [num_samples, 1])
+
+        pred_boxes = result['pred_boxes']
+        result = self.refinement(tiled_obj_vecs, pos_pred_vecs, pred_boxes, tiled_s, tiled_o, training=False)
+
+        step_result['pred_boxes'] = tf.reshape(pred_boxes, (num_samples, O, 4))
+        step_result['pred_boxes_refine'] = tf.reshape(result['bb_predicted'], (num_samples, O, 4))
+        step_result['pos_triples'] = tf.reshape(tf.stack([tf.tile(s, [num_samples]), pos_pred, tf.tile(o, [num_samples])], axis=1), (num_samples, -1, 3))
+
+        return step_result
+
+    def rerank_step(self, objs, pos_triples, boxes):
+        """score candidate layouts with classifier
+
+        all the candidates of all the layouts are scored in one call
+
+        Args:
+            objs: (O, )
+            pos_triples: (M, T, 3) triples of every candidate
+            boxes: (M, O, 4) boxes of every candidate
+
+        Returns:
+            step_result: dict, scores (M, L)
+        """
+        step_result = {}
+
+        num_samples = tf.shape(boxes)[0]
+        O = tf.shape(objs)[0]
+
+        # candidates share s and o, only the relations may differ
+        s, _, o = self.split_graph(objs, pos_triples[0])
+        pos_pred = tf.reshape(pos_triples[:, :, 1], (-1,))
+        tiled_objs = tf.tile(objs, [num_samples])
+        tiled_s, tiled_o = tile_edges(s, o, O, num_samples)
+
+        _, layout_sizes, _, _ = layout_offsets(tiled_objs)
+        num_graphs = tf.size(layout_sizes)
+
+        result = self.classifier({
+            'obj_vecs': self.obj_embedding(tiled_objs, training=False),
+            'pred_vecs': self.pos_pred_embedding(pos_pred, training=False),
+            's_idx': tiled_s,
+            'o_idx': tiled_o,
+            'boxes': tf.reshape(boxes, (-1, 4)),
+            'graph_ids': tf.repeat(tf.range(num_graphs), layout_sizes),
+            'num_graphs': num_graphs
+        }, training=False)
+
+        step_result['scores'] = tf.reshape(result['score'][:, 1], (num_samples, -1))
+
+        return step_result
+
+    def generation_train_step(self, objs, boxes, pos_triples_gt):
+        step_result = {}
+
+        s, pos_pred, o = self.split_graph(objs, pos_triples_gt)
+
+        with tf.GradientTape() as tape:
+            obj_vecs = self.obj_embedding(objs, training=True)
+            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
+
+            result = self.generation(objs, obj_vecs, pos_pred_vecs, boxes, s, o, training=True)
+            step_result['pred_boxes'] = result['pred_boxes']
+            # `result` contains output of k iterations
+            gen_loss = self.generation_loss(
+                bb_gt=boxes,
+                bb_predicted=result['pred_boxes'],
+                mu=result['mu'],
+                var=result['var'],
+                mu_prior=result['mu_prior'],
+                var_prior=result['var_prior']
+            )
+            step_result['gen_loss'] = gen_loss
+
+            scaled_loss = gen_loss / self.strategy.num_replicas_in_sync
+
+        train_var = self.generation.trainable_variables
+        gradients = tape.gradient(scaled_loss, train_var)
+        self.generation_optimizer.apply_gradients(
+            zip(gradients, train_var)
+        )
+
+        return step_result
+
+    def generation_eval_step(self, objs, boxes, pos_triples_gt):
+        step_result = {}
+
+        # not using predicted relation
+        s, pos_pred, o = self.split_graph(objs, pos_triples_gt)
+
+        obj_vecs = self.obj_embedding(objs, training=False)
+        pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+
+        result = self.generation(objs, obj_vecs, pos_pred_vecs, boxes, s, o, training=False)
+        step_result['pred_boxes'] = result['pred_boxes']
+
+        return step_result
+
+    def refinement_train_step(self, objs, boxes, pos_triples_gt):
+        step_result = {}
+
+        s, pos_pred, o = self.split_graph(objs, pos_triples_gt)
+
+        with tf.GradientTape() as tape:
+            obj_vecs = self.obj_embedding(objs, training=True)
+            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
+
+            boxes_adjust = boxes + tf.random.uniform(shape=tf.shape(boxes), minval=-0.05, maxval=0.05)
+            result = self.refinement(obj_vecs, pos_pred_vecs, boxes_adjust, s, o, training=True)
+
+            step_result['pred_boxes_refine'] = result['bb_predicted']
+
+            refine_loss = self.refinement_loss(boxes, result['bb_predicted'])
+            step_result['refine_loss'] = refine_loss
+
+            scaled_loss = refine_loss / self.strategy.num_replicas_in_sync
+
+        train_var = self.refinement.trainable_variables
+        gradients = tape.gradient(scaled_loss, train_var)
+
+        self.refinement_optimizer.apply_gradients(
+            zip(gradients, train_var)
+        )
+
+        return step_result
+
+    def refinement_eval_step(self, objs, pred_boxes, pos_triples_gt):
+        step_result = {}
+
+        # not using predicted relation
+        s, pos_pred, o = self.split_graph(objs, pos_triples_gt)
+
+        obj_vecs = self.obj_embedding(objs, training=False)
+        pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+
+        result = self.refinement(obj_vecs, pos_pred_vecs, pred_boxes, s, o, training=False)
+        step_result['pred_boxes_refine'] = result['bb_predicted']
+
+        return step_result
+
+    def restore(self, checkpoint_path):
+        """restore the modules that are built from checkpoint_path, the other values of the checkpoint are ignored
+
+        the names of the objects saved in the checkpoint, e.g. pos_relation, are kept in restored_objects
+        """
+        with self.timer.stage('restore'):
+            self.ckpt.restore(checkpoint_path).expect_partial()
+            self.restored_objects = {name.split('/')[0] for name, _ in tf.train.list_variables(checkpoint_path)}
+
+    def restore_classifier(self, checkpoint_path):
+        """restore classifier from a checkpoint of tf.train.Checkpoint(classifier=LayoutClassifier(...)),
+        every variable of classifier must be in the checkpoint
+        """
+        assert self.classifier_ckpt is not None, 'classifier is not built'
+        assert checkpoint_path, 'reranking needs a classifier checkpoint'
+
+        with self.timer.stage('restore'):
+            status = self.classifier_ckpt.restore(checkpoint_path)
+            try:
+                status.assert_existing_objects_matched()
+            except AssertionError as e:
+                raise AssertionError('%s does not hold the weights of classifier: %s' % (checkpoint_path, e))
+
+        self.classifier_restored = True
 
     def test(self, config, checkpoint_path, output_dir):
-        sample_dataset = tf.data.Dataset.list_files(os.path.join(config['data_dir'], '*.json'))
-        sample_dataset = sample_dataset.repeat().batch(batch_size=1)
+        sample_dataset = build_layout_dataset(config['data_dir'], self.vocab, batch_size=1, shuffle=False)
+        sample_iterator = iter(sample_dataset)
 
-        self.ckpt.restore(checkpoint_path)
+        self.restore(checkpoint_path)
 
         for idx in range(10):
-            # objs, boxes, pos_triples_gt, size_triples_gt = self.fetch_one_data(dataset=sample_dataset)
-            objs, boxes, pos_triples_gt = self.fetch_one_data(dataset=sample_dataset)
+            objs, boxes, pos_triples_gt = next(sample_iterator)
 
             result = self.run_step(config, objs, boxes, pos_triples_gt, config['part'], training=False)
             
-            # this 2 results, use the predicted relation to generate
-            # self.draw_boxes(objs, result['pred_boxes_use_predicted'], os.path.join(output_dir, 'test_%d_predicted_with_relation.png' % idx))
-            # self.draw_boxes(objs, result['pred_boxes_refine_use_predicted'], os.path.join(output_dir, 'test_%d_refine_with_relaton.png' % idx))
+            # this 2 results, use the relationship predicted by relation, only __in_image__ is known
+            if config['part'] == 'generation' and 'pos_relation' in self.restored_objects:
+                unknown = len(self.vocab['pos_pred_name_to_idx']) - 1
+                pos_pred_unknown = tf.where(tf.equal(pos_triples_gt[:, 1], 0), 0, unknown)
+                pos_triples_unknown = tf.stack([pos_triples_gt[:, 0], pos_pred_unknown, pos_triples_gt[:, 2]], axis=1)
+
+                result_use_predicted = self.steps['inference'](objs, pos_triples_unknown)
+                self.draw_boxes(objs, result_use_predicted['pred_boxes'], os.path.join(output_dir, 'test_%d_predicted_with_relation.png' % idx))
+                self.draw_boxes(objs, result_use_predicted['pred_boxes_refine'], os.path.join(output_dir, 'test_%d_refine_with_relation.png' % idx))
             
             # this 2 results, use the gt relation to generate
             self.draw_boxes(objs, result['pred_boxes'], os.path.join(output_dir, 'test_%d_predicted.png' % idx))
             self.draw_boxes(objs, result['pred_boxes_refine'], os.path.join(output_dir, 'test_%d_refine.png' % idx))
             self.draw_boxes(objs, boxes, os.path.join(output_dir, 'test_%d_gt.png' % idx))
 
+        self.renderer.close()
+
+
+    def generate(self, designs, batch_size=16):
+        """generate layouts from design constraints
+
+        relation completion, generation and refinement run in one compiled step
+        on batch_size designs at once, see inference_step
+
+        Args:
+            designs: list of dict
+                categories: list of category names of the elements
+                relations: optional, list of [s, relation name, o], s and o are indices in categories
+            batch_size: number of designs in one batch
+
+        Returns:
+            layouts: list of (N, 4) refined boxes [x0, y0, w, h], one box per category
+        """
+        layouts = []
+
+        for start in range(0, len(designs), batch_size):
+            graphs = [
+                build_design_graph(design['categories'], design.get('relations', []), self.vocab)
+                for design in designs[start : start + batch_size]
+            ]
+            objs, pos_triples = concat_graphs(graphs)
+
+            result = self.steps['inference'](tf.convert_to_tensor(objs), tf.convert_to_tensor(pos_triples))
+
+            # drop the box of __image__ item of every layout
+            layouts += [layout_boxes[:-1] for _, layout_boxes in self.split_layouts(objs, result['pred_boxes_refine'].numpy())]
+
+        return layouts
+
+    def sample_candidates(self, designs, num_samples, batch_size=16, sample_relations=False, top_k=None):
+        """generate num_samples candidate layouts for every design
+
+        Args:
+            designs: list of dict, see generate
+            num_samples: number of candidates of every design
+            batch_size: number of designs in one batch
+            sample_relations: predict the missing relations of every candidate separately,
+                otherwise candidates share the relations and the encoder of generation
+            top_k: if set, rerank candidates with classifier and keep the best top_k,
+                classifier must be restored first, see restore_classifier
+
+        Returns:
+            candidates: list of (num_samples or top_k, N, 4) refined boxes [x0, y0, w, h],
+                sorted by score if top_k is set
+        """
+        assert not top_k or self.classifier_restored, 'top_k needs the weights of classifier, see restore_classifier'
+
+        step = self.steps['sample_candidates_relations' if sample_relations else 'sample_candidates']
+        candidates = []
+
+        for start in range(0, len(designs), batch_size):
+            graphs = [
+                build_design_graph(design['categories'], design.get('relations', []), self.vocab)
+                for design in designs[start : start + batch_size]
+            ]
+            objs, pos_triples = concat_graphs(graphs)
+
+            result = step(tf.convert_to_tensor(objs), tf.convert_to_tensor(pos_triples), tf.constant(num_samples))
+
+            # (M, O, 4)
+            pred_boxes_refine = result['pred_boxes_refine'].numpy()
+
+            if top_k:
+                # (M, L)
+                scores = self.steps['rerank'](
+                    tf.convert_to_tensor(objs), result['pos_triples'], result['pred_boxes_refine'])['scores'].numpy()
+
+            offset = 0
+            for layout_idx, (graph_objs, _) in enumerate(graphs):
+                # drop the box of __image__ item
+                layout_candidates = pred_boxes_refine[:, offset : offset + len(graph_objs) - 1]
+
+                if top_k:
+                    layout_candidates = layout_candidates[np.argsort(-scores[:, layout_idx])[:top_k]]
+
+                candidates.append(layout_candidates)
+                offset += len(graph_objs)
+
+        return candidates
+
+    def generate_dir(self, config, checkpoint_path, input_dir, output_dir, batch_size=16, num_samples=1, top_k=None, classifier_checkpoint_path=None):
+        """generate a layout json for every design json of input_dir
+
+        a design json is {"categories": [...], "relations": [[s, relation name, o], ...]},
+        the layout json has the same name and the format of the dataset.
+        with more than one candidate, candidate m is saved as <name>_<m>.json,
+        with top_k, candidates are reranked by the classifier of classifier_checkpoint_path and m is the rank
+        """
+        assert not top_k or num_samples > 1, 'top_k reranks candidates, num_samples must be greater than 1'
+
+        self.restore(checkpoint_path)
+        if top_k:
+            self.restore_classifier(classifier_checkpoint_path)
+
+        paths = sorted(glob.glob(os.path.join(input_dir, '*.json')))
+
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start : start + batch_size]
+
+            designs = []
+            for path in batch_paths:
+                with open(path) as f:
+                    designs.append(json.load(f))
+
+            # the first batch includes tracing the steps
+            with self.timer.stage('generate'):
+                if num_samples == 1:
+                    candidates = [boxes[None] for boxes in self.generate(designs, batch_size=batch_size)]
+                else:
+                    candidates = self.sample_candidates(designs, num_samples, batch_size=batch_size, top_k=top_k)
+
+            for path, design, boxes in zip(batch_paths, designs, candidates):
+                objs = [self.vocab['object_name_to_idx'][category] for category in design['categories']]
+                name, ext = os.path.splitext(os.path.basename(path))
+
+                for m in range(len(boxes)):
+                    output_name = name + ext if len(boxes) == 1 else '%s_%d%s' % (name, m, ext)
+                    save_layout(os.path.join(output_dir, output_name), objs, boxes[m], self.vocab)
+
+            print('Generated %d / %d layouts.' % (start + len(batch_paths), len(paths)))
+
+    def export(self, config, checkpoint_path, output_dir, quantization='float16', num_batches=10):
+        """export a checkpoint to quantized TFLite models and report their drift
+
+        drift is measured on num_batches batches of test_data_dir, see models.lite
+
+        Returns:
+            drift: dict, see lite_drift
+        """
+        # TFLite conversion is only imported to export
+        from models.lite import export_lite, lite_drift
+
+        self.restore(checkpoint_path)
+
+        sizes = export_lite(self, output_dir, quantization=quantization)
+        for name, size in sizes.items():
+            print('Exported %s, %d bytes.' % (name, size))
+
+        test_dataset = build_layout_dataset(
+            config['test_data_dir'], self.vocab, batch_size=config.get('batch_size', 16),
+            shuffle=False, shuffle_files=False, repeat=False)
+
+        drift = lite_drift(self, output_dir, test_dataset, num_batches=num_batches)
+        print(' '.join('%s: %f.' % (name, value) for name, value in drift.items()))
+
+        return drift
+
+    def evaluate(self, config):
+        """one deterministic pass over the whole test set
+
+        Returns:
+            metrics: dict, of the modules of config['part'], of every module if part is not set
+                pos_relation_acc: position relation accuracy with all relations unknown
+                recon_loss: L1 error of refined boxes, generated with gt relations
+                recon_loss_coarse: L1 error of generated boxes before refinement
+        """
+        test_dataset = build_layout_dataset(
+            config['test_data_dir'], self.vocab, batch_size=config.get('batch_size', 16),
+            shuffle=False, shuffle_files=False, repeat=False)
+
+        pos_relation_acc = keras.metrics.CategoricalAccuracy()
+        recon_loss = keras.metrics.MeanAbsoluteError()
+        recon_loss_coarse = keras.metrics.MeanAbsoluteError()
+
+        part = config.get('part')
+        evaluate_relation = part in [None, 'all', 'relation']
+        evaluate_generation = part in [None, 'all', 'generation']
+
+        for objs, boxes, pos_triples_gt in test_dataset:
+            if evaluate_relation:
+                result = self.steps['relation_eval'](objs, pos_triples_gt)
+                pos_relation_acc.update_state(result['gt_pos_cls'], result['pred_pos_cls'])
+
+            if evaluate_generation:
+                result = self.steps['generation_eval'](objs, boxes, pos_triples_gt)
+                result.update(self.steps['refinement_eval'](objs, result['pred_boxes'], pos_triples_gt))
+                recon_loss.update_state(boxes, result['pred_boxes_refine'])
+                recon_loss_coarse.update_state(boxes, result['pred_boxes'])
+
+        metrics = {}
+        if evaluate_relation:
+            metrics['pos_relation_acc'] = float(pos_relation_acc.result().numpy())
+
+        if evaluate_generation:
+            metrics['recon_loss'] = float(recon_loss.result().numpy())
+            metrics['recon_loss_coarse'] = float(recon_loss_coarse.result().numpy())
+
+        return metrics
+
+    def evaluate_checkpoints(self, config, checkpoint_dir, log_dir, timeout=None):
+        """evaluate every new checkpoint of a training run, e.g. in a separate process
+
+        waits for checkpoints in checkpoint_dir, metrics are written to log_dir/eval
+        at the training step of the checkpoint
+        """
+        eval_summary_writer = tf.summary.create_file_writer(os.path.join(log_dir, 'eval'))
+
+        for checkpoint_path in tf.train.checkpoints_iterator(checkpoint_dir, timeout=timeout):
+            self.restore(checkpoint_path)
+            step = int(self.global_step.numpy())
+
+            metrics = self.evaluate(config)
+            print('Checkpoint: %s. Step: %d. %s' % (
+                checkpoint_path, step, ' '.join('%s: %f.' % (name, value) for name, value in metrics.items())))
+
+            with eval_summary_writer.as_default():
+                for name, value in metrics.items():
+                    tf.summary.scalar(name, value, step=step)
 
     def run(self, config):
-        train_dataset = tf.data.Dataset.list_files(os.path.join(config['data_dir'], '*.json'))
-        train_dataset = train_dataset.repeat().shuffle(buffer_size=100).batch(batch_size=config['batch_size'])
-        test_dataset = tf.data.Dataset.list_files(os.path.join(config['test_data_dir'], '*.json'))
-        test_dataset = test_dataset.repeat().shuffle(buffer_size=100).batch(batch_size=config['batch_size'])
-        sample_dataset = tf.data.Dataset.list_files(os.path.join(config['sample_data_dir'], '*.json'))
-        sample_dataset = sample_dataset.repeat().batch(batch_size=1)
+        # batches of batch_size layouts, or of layouts of similar size up to a budget of triples
+        batching = config.get('batching', 'fixed')
+        assert batching in ['fixed', 'budget'], 'Invalid batching "%s"' % batching
+        budget = {}
+        if batching == 'budget':
+            budget = {'edge_budget': config['edge_budget'], 'bucket_boundaries': config['bucket_boundaries']}
+
+        # iterators live for the whole run, so the pipelines keep parsing
+        # and prefetching batches while the model is running.
+        # with several workers, each one reads its own shard of the files
+        train_iterator = iter(build_layout_dataset(
+            config['data_dir'], self.vocab, batch_size=config['batch_size'],
+            num_shards=self.num_workers, shard_index=self.worker_index, **budget))
+        sample_iterator = iter(build_layout_dataset(config['sample_data_dir'], self.vocab, batch_size=1, shuffle=False))
         
         if self.save:
-            ckpt_manager = tf.train.CheckpointManager(
+            # every worker takes part in the snapshot of the variables,
+            # only the checkpoints of chief are kept.
+            # workers stage into their own directories, a snapshot of chief is never removed by another worker
+            staging_dir = config.get('checkpoint_staging_dir') or None
+            if staging_dir and self.num_workers > 1:
+                staging_dir = os.path.join(staging_dir, 'worker-%d' % self.worker_index)
+                os.makedirs(staging_dir, exist_ok=True)
+
+            checkpointer = AsyncCheckpointer(
                 self.ckpt,
-                config['checkpoint_dir'],
-                max_to_keep=config['checkpoint_max_to_keep']
+                config['checkpoint_dir'] if self.is_chief else None,
+                max_to_keep=config['checkpoint_max_to_keep'],
+                staging_dir=staging_dir
             )
 
             # init tensorboard writer
-            train_log_dir = os.path.join(config['log_dir'], 'train')
-            test_log_dir = os.path.join(config['log_dir'], 'test')
-            train_summary_writer = tf.summary.create_file_writer(train_log_dir)
-            test_summary_writer = tf.summary.create_file_writer(test_log_dir)
+            if self.is_chief:
+                train_log_dir = os.path.join(config['log_dir'], 'train')
+                test_log_dir = os.path.join(config['log_dir'], 'test')
+                train_summary_writer = tf.summary.create_file_writer(train_log_dir)
+                test_summary_writer = tf.summary.create_file_writer(test_log_dir)
+            else:
+                train_summary_writer = test_summary_writer = tf.summary.create_noop_writer()
+
+        # evaluation runs on the whole test set with its own cadence, on chief only
+        eval_schedule = Schedule(config.get('eval_every_steps', 0), config.get('eval_every_secs', 0))
+
+        # the workers must save at the same steps, the clocks of the workers do not agree
+        checkpoint_every_secs = config.get('checkpoint_every_secs', 0)
+        if self.num_workers > 1 and checkpoint_every_secs:
+            print('checkpoint_every_secs is ignored with %d workers.' % self.num_workers)
+            checkpoint_every_secs = 0
+        checkpoint_schedule = Schedule(config['checkpoint_every'], checkpoint_every_secs)
+
+        # optional tf.profiler trace of a range of steps
+        trace_window = TraceWindow(config['log_dir'], config.get('profile_trace_steps') if self.is_chief else None)
 
         # define metrics
         pos_relation_acc = keras.metrics.CategoricalAccuracy()
@@ -318,8 +936,14 @@ class NeuralDesignNetwork:
 
         # start training
         while self.iter_cnt < config['max_iteration_number']:
-            # objs, boxes, pos_triples_gt, size_triples_gt = self.fetch_one_data(dataset=train_dataset)
-            objs, boxes, pos_triples_gt = self.fetch_one_data(dataset=train_dataset)
+            trace_window.update(self.iter_cnt)
+            step_start = time.perf_counter()
+
+            with self.timer.stage('data'):
+                objs, boxes, pos_triples_gt = next(train_iterator)
+            # reading the count waits for the batch, so it is only taken to report examples/sec
+            if self.timer.enabled:
+                num_layouts = int(tf.math.count_nonzero(tf.equal(objs, 0)))
 
             result = self.run_step(config, objs, boxes, pos_triples_gt, part=config['part'], training=True)
 
@@ -346,7 +970,7 @@ class NeuralDesignNetwork:
                 print('Step: %d. Refine Loss: %f.' % (self.iter_cnt, refine_loss.numpy()))
             
             if self.save:
-                with train_summary_writer.as_default():
+                with self.timer.stage('summaries'), train_summary_writer.as_default():
                     if config['part'] == 'relation':
                         tf.summary.scalar('pos_loss', pos_loss, step=self.iter_cnt)
                         tf.summary.scalar('pos_relation_acc', pos_relation_acc.result(), step=self.iter_cnt)
@@ -359,47 +983,54 @@ class NeuralDesignNetwork:
                         tf.summary.scalar('refine_loss', refine_loss, step=self.iter_cnt)
 
                         recon_loss.reset_states()
+
+                    tf.summary.scalar('retrace_count', sum(self.trace_count.values()), step=self.iter_cnt)
+
+                    # sample training results, predicted and gt layouts side by side
+                    if self.is_chief and config['part'] == 'generation' and self.iter_cnt % int(config['sample_every']) == 0:
+                        with self.timer.stage('render'):
+                            train_layouts = self.split_layouts(objs.numpy(), pred_boxes.numpy(), boxes.numpy())[:6]
+                            sheet = contact_sheet([
+                                rasterize([(layout[0], layout[col]) for layout in train_layouts]) for col in range(1, 3)
+                            ])
+                        tf.summary.image('training_samples', sheet[None], step=self.iter_cnt)
             
             
-            if self.save and (self.iter_cnt + 1) % config['checkpoint_every'] == 0:
-                ckpt_manager.save()
-                print('Checkpoint saved.')
+            if self.save and checkpoint_schedule.is_due(self.iter_cnt):
+                self.global_step.assign(self.iter_cnt)
+                with self.timer.stage('checkpoint'):
+                    snapshot_secs = checkpointer.save(self.iter_cnt)
+                print('Checkpoint saved in %f seconds.' % snapshot_secs)
+
+                with train_summary_writer.as_default():
+                    tf.summary.scalar('checkpoint_snapshot_secs', snapshot_secs, step=self.iter_cnt)
+
+            if self.save:
+                with train_summary_writer.as_default():
+                    for step, write_secs in checkpointer.pop_write_timings():
+                        tf.summary.scalar('checkpoint_write_secs', write_secs, step=step)
             
             """
             start testing
             """
-            objs, boxes, pos_triples_gt = self.fetch_one_data(dataset=test_dataset)
+            if self.is_chief and eval_schedule.is_due(self.iter_cnt):
+                with self.timer.stage('evaluate'):
+                    metrics = self.evaluate(config)
+                print('Step: %d. Test %s' % (self.iter_cnt, ' '.join('%s: %f.' % (name, value) for name, value in metrics.items())))
 
-            result = self.run_step(config, objs, boxes, pos_triples_gt, part=config['part'], training=False)
-            
-            if config['part'] == 'relation':
-                gt_pos_cls = result['gt_pos_cls']
-                pred_pos_cls = result['pred_pos_cls']
-                pos_relation_acc.update_state(gt_pos_cls, pred_pos_cls)
-            
-            if config['part'] == 'generation':
-                pred_boxes = result['pred_boxes']
-                pred_boxes_refine = result['pred_boxes_refine']
-            
-                recon_loss.update_state(boxes, pred_boxes_refine)
-
-            if self.save:
-                with test_summary_writer.as_default():
-                    if config['part'] == 'relation':
-                        tf.summary.scalar('pos_relation_acc', pos_relation_acc.result(), step=self.iter_cnt)
-                        pos_relation_acc.reset_states()
-
-                    if config['part'] == 'generation':
-                        tf.summary.scalar('recon_loss', recon_loss.result(), step=self.iter_cnt)
-                        recon_loss.reset_states()
-            
+                if self.save:
+                    with test_summary_writer.as_default():
+                        for name, value in metrics.items():
+                            tf.summary.scalar(name, value, step=self.iter_cnt)
 
             """
             start sampling
             """
-            if self.iter_cnt % int(config['sample_every']) == 0:
+            if self.is_chief and self.iter_cnt % int(config['sample_every']) == 0:
+                sample_layouts = []
+
                 for idx in range(4):
-                    objs, boxes, pos_triples_gt = self.fetch_one_data(dataset=sample_dataset)
+                    objs, boxes, pos_triples_gt = next(sample_iterator)
 
                     result = self.run_step(config, objs, boxes, pos_triples_gt, part=config['part'], training=False)
                     
@@ -408,224 +1039,71 @@ class NeuralDesignNetwork:
                         pred_pos_cls = result['pred_pos_cls']
                     
                     if config['part'] == 'generation':
-                        pred_boxes = result['pred_boxes']
-                        pred_boxes_refine = result['pred_boxes_refine']
-
-                        self.draw_boxes(
-                            objs,
-                            pred_boxes, 
-                            os.path.join(
-                                self.config['train_sample_dir'], 'train_%d_%d_predicted.png' 
-                                % (self.iter_cnt, idx)
-                            )
-                        )
-
-                        self.draw_boxes(
-                            objs,
-                            pred_boxes_refine,
-                            os.path.join(
-                                self.config['train_sample_dir'], 'train_%d_%d_refined.png' 
-                                % (self.iter_cnt, idx)
-                            )
-                        )
-
-                        self.draw_boxes(
-                            objs,
-                            boxes,
-                            os.path.join(
-                                self.config['train_sample_dir'], 'train_%d_%d_gt.png' 
-                                % (self.iter_cnt, idx)
-                            )
-                        )
-
+                        sample_layouts.append((objs.numpy(), result['pred_boxes'].numpy(), result['pred_boxes_refine'].numpy(), boxes.numpy()))
+
+                # predicted, refined and gt layouts side by side
+                if self.save and sample_layouts:
+                    with self.timer.stage('render'):
+                        sheet = contact_sheet([
+                            rasterize([(layout[0], layout[col]) for layout in sample_layouts]) for col in range(1, 4)
+                        ])
+
+                    with train_summary_writer.as_default():
+                        tf.summary.image('samples', sheet[None], step=self.iter_cnt)
+
+            if self.timer.enabled:
+                step_secs = time.perf_counter() - step_start
+                timings = self.timer.pop()
+                print('Step: %d. %f layouts/sec. %s' % (
+                    self.iter_cnt, num_layouts / step_secs, ' '.join('%s: %fs.' % (name, secs) for name, secs in timings.items())))
+
+                if self.save:
+                    with train_summary_writer.as_default():
+                        tf.summary.scalar('examples_per_sec', num_layouts / step_secs, step=self.iter_cnt)
+                        tf.summary.scalar('step_secs', step_secs, step=self.iter_cnt)
+                        for name, secs in timings.items():
+                            tf.summary.scalar('stage_secs/' + name, secs, step=self.iter_cnt)
 
             self.iter_cnt += 1
 
-    def run_step(self, config, objs, boxes, pos_triples_gt, part, training=True):
-        step_result = {}
+        trace_window.stop()
 
-        s, pos_pred_gt, o = self.split_graph(objs, pos_triples_gt)
+        if self.save:
+            checkpointer.close()
 
-        # randomly mask to generate training data
-        pos_pred = pos_pred_gt.numpy()
-        for idx, _ in enumerate(pos_pred):
-            if pos_pred[idx] != 0:
-                if random.random() <= config['mask_rate']:
-                    pos_pred[idx] = len(self.vocab['pos_pred_name_to_idx']) - 1
-
-        pos_pred = tf.convert_to_tensor(pos_pred)
-
-        # train relation
-        if training and config['part'] == 'relation':
-            # train pos relation
-            with tf.GradientTape() as tape:
-                # get embedding of obj and pred
-                obj_vecs = self.obj_embedding(objs, training=True)
-                pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
-                pred_gt_vecs = self.pos_pred_embedding(pos_pred_gt, training=True)
-
-                result = self.pos_relation(obj_vecs, pred_gt_vecs, s, o, pred_vecs=pred_vecs, training=True)
-
-                # embedding pred with one_hot, to calculate cross entropy loss
-                pred_gt_one_hot = tf.one_hot(pos_pred_gt, depth=len(self.vocab['pos_pred_name_to_idx']))
-                step_result['gt_pos_cls'] = pred_gt_one_hot
-                # get latent variable of G_gt
-                # z = tf.concat([result['obj_vecs_with_gt'], result['pred_vecs_with_gt']], axis=0)
-                pos_loss = self.relation_loss(pred_gt_one_hot, result['pred_cls'], result['z_mu'], result['z_var'])
-                step_result['pos_loss'] = pos_loss
-                step_result['pred_pos_cls'] = result['pred_cls']
-
-            train_var = self.pos_relation.trainable_variables \
-                        + self.obj_embedding.trainable_variables + self.pos_pred_embedding.trainable_variables
-            gradients = tape.gradient(pos_loss, train_var)
-
-            self.relation_optimizer.apply_gradients(
-                zip(gradients, train_var)
-            )
-        
-        elif config['part'] == 'relation':
-            pos_pred = tf.ones_like(pos_pred_gt) * (len(self.vocab['pos_pred_name_to_idx']) - 1)
+        self.renderer.close()
 
-            obj_vecs = self.obj_embedding(objs, training=False)
+    def run_step(self, config, objs, boxes, pos_triples_gt, part, training=True):
+        step_result = {}
 
-            pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
-            result = self.pos_relation(obj_vecs, pred_vecs, s, o, training=False)
-            pred_gt_one_hot = tf.one_hot(pos_pred_gt, depth=len(self.vocab['pos_pred_name_to_idx']))
-            step_result['gt_pos_cls'] = pred_gt_one_hot
-            step_result['pred_pos_cls'] = result['pred_cls']
+        # train relation, relations are masked inside the step
+        if training and part == 'relation':
+            with self.timer.stage('relation_train'):
+                step_result.update(self.steps['relation_train'](objs, pos_triples_gt, tf.constant(self.iter_cnt, dtype=tf.int64)))
 
-        # train generation
-        s, pos_pred, o = self.split_graph(objs, pos_triples_gt)
-        
-        if training and config['part'] == 'generation':
-            with tf.GradientTape() as tape:
-                obj_vecs = self.obj_embedding(objs, training=True)
-                pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
-
-                result = self.generation(objs, obj_vecs, pos_pred_vecs, boxes, s, o, training=True)
-                step_result['pred_boxes'] = result['pred_boxes']
-                # `result` contains output of k iterations
-                gen_loss = self.generation_loss(
-                    bb_gt=boxes, 
-                    bb_predicted=result['pred_boxes'],
-                    mu=result['mu'],
-                    var=result['var'],
-                    mu_prior=result['mu_prior'],
-                    var_prior=result['var_prior']
-                )
-                step_result['gen_loss'] = gen_loss
-            
-            
-            train_var = self.generation.trainable_variables
-            gradients = tape.gradient(gen_loss, train_var)
-            self.generation_optimizer.apply_gradients(
-                zip(gradients, train_var)
-            )
+        elif part == 'relation':
+            with self.timer.stage('relation_eval'):
+                step_result.update(self.steps['relation_eval'](objs, pos_triples_gt))
 
-            # sample training results
-            if self.iter_cnt % int(config['sample_every']) == 0:
-                layout_size_list = []
-                temp_layout = []
-                for item in objs.numpy():
-                    if item != 0:
-                        temp_layout.append(item)
-                    else:
-                        layout_size_list.append(len(temp_layout) + 1)
-                        temp_layout = []
-                
-                offset = 0
-                for k_idx, layout_size in enumerate(layout_size_list):
-                    temp_objs = objs[offset : layout_size + offset]
-                    temp_boxes = step_result['pred_boxes'][offset : layout_size + offset]
-                    self.draw_boxes(temp_objs, temp_boxes, os.path.join(
-                        self.config['train_sample_dir'], 'training_%d_%d_predicted.png' % (self.iter_cnt, k_idx)
-                    ))
-
-                    temp_boxes = boxes[offset : layout_size + offset]
-                    self.draw_boxes(temp_objs, temp_boxes, os.path.join(
-                        self.config['train_sample_dir'], 'training_%d_%d_gt.png' % (self.iter_cnt, k_idx)
-                    ))
-
-                    offset += layout_size
-
-                    if k_idx >= 5:
-                        break
-        
-        elif config['part'] == 'generation':
-            # not using predicted relation
-            obj_vecs = self.obj_embedding(objs, training=False)
-            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
-
-            result = self.generation(objs, obj_vecs, pos_pred_vecs, boxes, s, o, training=False)
-            step_result['pred_boxes'] = tf.convert_to_tensor(result['pred_boxes'])
+        # train generation
+        if training and part == 'generation':
+            with self.timer.stage('generation_train'):
+                step_result.update(self.steps['generation_train'](objs, boxes, pos_triples_gt))
 
-            # when not training
-            # use the relationship predicted by previous model
-            # pos_pred = tf.math.argmax(step_result['pred_pos_cls'], axis=1)
-            # pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
-            # result = self.generation(objs, obj_vecs, pos_pred_vecs, boxes, s, o, training=False)
-            # step_result['pred_boxes_use_predicted'] = tf.convert_to_tensor(result['pred_boxes'])
+        elif part == 'generation':
+            with self.timer.stage('generation_eval'):
+                step_result.update(self.steps['generation_eval'](objs, boxes, pos_triples_gt))
 
         # refinement part
-        if training and config['part'] == 'generation':
-            with tf.GradientTape() as tape:
-                obj_vecs = self.obj_embedding(objs, training=True)
-                pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=True)
-
-                boxes_adjust = boxes + tf.random.uniform(shape=boxes.shape, minval=-0.05, maxval=0.05)
-                result = self.refinement(obj_vecs, pos_pred_vecs, boxes_adjust, s, o, training=True)
-
-                step_result['pred_boxes_refine'] = result['bb_predicted']
-
-                refine_loss = self.refinement_loss(boxes, result['bb_predicted'])
-                step_result['refine_loss'] = refine_loss
-            
-            train_var = self.refinement.trainable_variables
-            gradients = tape.gradient(refine_loss, train_var)
-
-            self.refinement_optimizer.apply_gradients(
-                zip(gradients, train_var)
-            )
-
-        elif config['part'] == 'generation':
-            obj_vecs = self.obj_embedding(objs, training=False)
-
-            # not using predicted relation
-            pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
-            result = self.refinement(obj_vecs, pos_pred_vecs, step_result['pred_boxes'], s, o, training=False)
-            step_result['pred_boxes_refine'] = result['bb_predicted']
-
-            # when not training
-            # use the relationship predicted by previous model
-            # pos_pred = tf.math.argmax(step_result['pred_pos_cls'], axis=1)
-            # pos_pred_vecs = self.pos_pred_embedding(pos_pred, training=False)
+        if training and part == 'generation':
+            with self.timer.stage('refinement_train'):
+                step_result.update(self.steps['refinement_train'](objs, boxes, pos_triples_gt))
 
-            # result = self.refinement(obj_vecs, pos_pred_vecs, step_result['pred_boxes_use_predicted'], s, o, training=False)
-            # step_result['pred_boxes_refine_use_predicted'] = result['bb_predicted']
+        elif part == 'generation':
+            with self.timer.stage('refinement_eval'):
+                step_result.update(self.steps['refinement_eval'](objs, step_result['pred_boxes'], pos_triples_gt))
 
         return step_result
     
     def draw_boxes(self, obj_cls, boxes, output_path):
-        assert len(obj_cls) == len(boxes)
-
-        colormap = ['#aaaaaa','#0000ff', '#00ff00', '#00ffff', '#ff0000', '#ff00ff', '#ffff00', '#ffffff']
-        
-        CANVA_SIZE = 640
-        canva = Image.new('RGB', (CANVA_SIZE, CANVA_SIZE), (64, 64, 64))
-        draw = ImageDraw.Draw(canva)
-
-        for idx in range(len(obj_cls)):
-            if obj_cls[idx] == 0:
-                continue
-
-            temp_cls = obj_cls[idx]
-            x, y, w, h = boxes[idx]
-
-            x0 = x * CANVA_SIZE
-            y0 = y * CANVA_SIZE
-            x1 = x0 + w * CANVA_SIZE
-            y1 = y0 + h * CANVA_SIZE
-            
-            draw.rectangle([x0, y0, x1, y1], outline=colormap[temp_cls])
-
-        canva.save(output_path)
+        self.renderer.draw_boxes(obj_cls, boxes, output_path)
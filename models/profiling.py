@@ -0,0 +1,72 @@
+import time
+import contextlib
+import collections
+import tensorflow as tf
+
+
+class StageTimer:
+    """accumulate the wall time of the stages of training steps
+
+    compiled steps return once their outputs are computed,
+    so the time of a step includes the ops of its forward, backward and apply_gradients
+
+    Args:
+        enabled: if False, stage() does nothing
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.) + time.perf_counter() - start
+
+    def pop(self):
+        """
+        Returns:
+            timings: OrderedDict, seconds of every stage since the last pop
+        """
+        timings, self.timings = self.timings, collections.OrderedDict()
+        return timings
+
+
+class TraceWindow:
+    """record a tf.profiler trace of the steps [start_step, stop_step)
+
+    the trace is written to log_dir and shown by the profile tab of TensorBoard
+
+    Args:
+        log_dir: log directory of the run
+        steps: (start_step, stop_step), or None to record nothing
+    """
+    def __init__(self, log_dir, steps=None):
+        self.log_dir = log_dir
+        self.steps = steps
+        self.active = False
+
+    def update(self, step):
+        """call before running step"""
+        if self.steps is None:
+            return
+
+        start_step, stop_step = self.steps
+
+        if step == start_step and not self.active:
+            tf.profiler.experimental.start(self.log_dir)
+            self.active = True
+
+        elif step == stop_step and self.active:
+            self.stop()
+
+    def stop(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
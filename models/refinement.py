@@ -2,11 +2,10 @@ import tensorflow as tf
 from tensorflow import keras
 from models.graph import GraphTripleConvStack
 from models.layers import build_mlp
-import tensorflow_probability as tfp
 
 
 class NDNRefinement(keras.Model):
-    def __init__(self):
+    def __init__(self, gcn_engine='sparse', gcn_factorized=True, gcn_recompute=False):
         super(NDNRefinement, self).__init__()
         # TODO:
         # in paper, g_ft is a GCN
@@ -19,7 +18,7 @@ class NDNRefinement(keras.Model):
         node_bb_feature = keras.layers.Dense(64, activation=tf.nn.leaky_relu)(node_bb_input)
         self.node_bb_embedding = keras.Model(inputs=[node_input, bb_input], outputs=[node_bb_feature])
 
-        self.g_ft = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128,512, 128), (128, 128, 128)])
+        self.g_ft = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128,512, 128), (128, 128, 128)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
     
         node_feature = keras.layers.Input(shape=(128))
         predicted_bb = keras.layers.Dense(4, activation=tf.nn.leaky_relu)(node_feature)
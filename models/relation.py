@@ -1,23 +1,22 @@
 import tensorflow as tf
 from tensorflow import keras
-from models.graph import GraphTripleConvStack
+from models.graph import GraphTripleConvStack, tile_edges
 from models.layers import build_mlp
-import tensorflow_probability as tfp
 
 
 class NDNRelation(keras.Model):
-    def __init__(self, category_list, relation_list):
+    def __init__(self, category_list, relation_list, gcn_engine='sparse', gcn_factorized=True, gcn_recompute=False):
         super(NDNRelation, self).__init__()
         # the dimension of g_c and g_p are not same as supplementary
         # but i think this is right
-        self.g_c = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 32)])
+        self.g_c = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 32)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
         
         z_encoder_input = keras.layers.Input(shape=(32))
         z_mu = keras.layers.Dense(32)(z_encoder_input)
         z_var = keras.layers.Dense(32)(z_encoder_input)
         self.z_encoder = keras.Model(inputs=[z_encoder_input], outputs=[z_mu, z_var])
 
-        self.g_p = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 128)])
+        self.g_p = GraphTripleConvStack([(64, 512, 128), (128, 512, 128), (128, 512, 128), (128, 128, 128)], engine=gcn_engine, factorized=gcn_factorized, recompute=gcn_recompute)
         self.h_pred = build_mlp(
             dim_list=[
                 128, 
@@ -47,16 +46,17 @@ class NDNRelation(keras.Model):
         Returns:
             z: a sample result
         """
-        eps = tf.random.normal(shape=mu.shape)
+        eps = tf.random.normal(shape=tf.shape(mu))
         z = eps * tf.exp(var * .5) + mu
         return z
 
-    def call(self, obj_vecs, pred_gt_vecs, s_idx, o_idx, pred_vecs=None, training=True):
+    def call(self, obj_vecs, pred_gt_vecs, s_idx, o_idx, pred_vecs=None, z=None, training=True):
         """[summary]
 
         Args:
             objs ([type]): [description]
             triples_gt_dict ([type]): [description]
+            z: optional, (O, 32) latent variable used when not training, sampled from N(0, 1) if not given
 
         Returns:
             
@@ -81,13 +81,10 @@ class NDNRelation(keras.Model):
 
             result['z_mu'] = z_mu
             result['z_var'] = z_var
-        else:
+        elif z is None:
             # if not training
             # z should be sampled from N(0, 1)
-            normal_0_1 = tfp.distributions.Normal(loc=0., scale=1.)
-            # obj_vecs_with_gt = normal_0_1.sample(sample_shape=(obj_vecs.shape[0], 32))
-            # pred_vecs_with_gt = normal_0_1.sample(sample_shape=(pred_vecs.shape[0], 32))
-            z = normal_0_1.sample(sample_shape=(obj_vecs.shape[0], 32))
+            z = tf.random.normal(shape=(tf.shape(obj_vecs)[0], 32))
 
         # concat 
 
@@ -105,3 +102,34 @@ class NDNRelation(keras.Model):
         result['pred_cls'] = pred_cls
 
         return result
+
+    def sample(self, obj_vecs, pred_vecs, s_idx, o_idx, num_samples):
+        """predict relations with num_samples z for every element
+
+        the samples are evaluated in parallel as disjoint copies of the graph
+
+        Returns:
+            result: dict, pred_cls (num_samples, T, len(relation_list)), new_p (num_samples, T)
+        """
+        result = {}
+
+        O = tf.shape(obj_vecs)[0]
+        T = tf.shape(pred_vecs)[0]
+
+        z = tf.random.normal(shape=(num_samples * O, 32))
+
+        tiled_s_idx, tiled_o_idx = tile_edges(s_idx, o_idx, O, num_samples)
+        edges = tf.stack([tiled_s_idx, tiled_o_idx], axis=1)
+
+        new_obj_vecs = self.node_embedding([tf.tile(obj_vecs, [num_samples, 1]), z])
+
+        _, new_pred_vecs = self.g_p(new_obj_vecs, tf.tile(pred_vecs, [num_samples, 1]), edges, training=False)
+
+        pred_cls = self.h_pred(new_pred_vecs, training=False)
+        pred_cls = tf.keras.layers.Softmax()(pred_cls)
+        pred_cls = tf.reshape(pred_cls, (num_samples, T, -1))
+
+        result['new_p'] = tf.math.argmax(pred_cls, axis=-1)
+        result['pred_cls'] = pred_cls
+
+        return result
@@ -0,0 +1,151 @@
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+# same colors as draw_boxes, indexed by category
+COLORMAP = np.array([
+    [170, 170, 170], [0, 0, 255], [0, 255, 0], [0, 255, 255],
+    [255, 0, 0], [255, 0, 255], [255, 255, 0], [255, 255, 255]
+], dtype=np.uint8)
+
+
+def draw_boxes(obj_cls, boxes, output_path):
+    assert len(obj_cls) == len(boxes)
+
+    colormap = ['#aaaaaa','#0000ff', '#00ff00', '#00ffff', '#ff0000', '#ff00ff', '#ffff00', '#ffffff']
+
+    CANVA_SIZE = 640
+    canva = Image.new('RGB', (CANVA_SIZE, CANVA_SIZE), (64, 64, 64))
+    draw = ImageDraw.Draw(canva)
+
+    for idx in range(len(obj_cls)):
+        if obj_cls[idx] == 0:
+            continue
+
+        temp_cls = obj_cls[idx]
+        x, y, w, h = boxes[idx]
+
+        x0 = x * CANVA_SIZE
+        y0 = y * CANVA_SIZE
+        x1 = x0 + w * CANVA_SIZE
+        y1 = y0 + h * CANVA_SIZE
+
+        draw.rectangle([x0, y0, x1, y1], outline=colormap[temp_cls])
+
+    canva.save(output_path)
+
+
+def rasterize(layouts, image_size=128):
+    """draw the box outlines of a batch of layouts at once
+
+    Args:
+        layouts: list of (obj_cls (N, ), boxes (N, 4) [x0, y0, w, h])
+        image_size: size of every image
+
+    Returns:
+        images: (len(layouts), image_size, image_size, 3) uint8
+    """
+    S = image_size
+    images = np.full((len(layouts), S, S, 3), 64, dtype=np.uint8)
+
+    if len(layouts) == 0:
+        return images
+
+    image_idx = np.concatenate([np.full(len(obj_cls), idx) for idx, (obj_cls, _) in enumerate(layouts)])
+    obj_cls = np.concatenate([np.asarray(obj_cls) for obj_cls, _ in layouts]).astype(np.int64)
+    boxes = np.concatenate([np.asarray(boxes, dtype=np.float32).reshape((-1, 4)) for _, boxes in layouts])
+
+    # __image__ item is not drawn
+    keep = obj_cls != 0
+    image_idx, obj_cls, boxes = image_idx[keep], obj_cls[keep], boxes[keep]
+
+    def to_pixel(a, b):
+        a, b = np.minimum(a, b) * S, np.maximum(a, b) * S
+        return [np.clip(np.floor(v), 0, S - 1).astype(np.int64) for v in [a, b]]
+
+    x0, x1 = to_pixel(boxes[:, 0], boxes[:, 0] + boxes[:, 2])
+    y0, y1 = to_pixel(boxes[:, 1], boxes[:, 1] + boxes[:, 3])
+    colors = COLORMAP[obj_cls]
+
+    pixels = np.arange(S)
+
+    # (box, x) of every pixel of horizontal edges
+    k, x = np.nonzero((pixels >= x0[:, None]) & (pixels <= x1[:, None]))
+    for y in [y0, y1]:
+        images[image_idx[k], y[k], x] = colors[k]
+
+    # (box, y) of every pixel of vertical edges
+    k, y = np.nonzero((pixels >= y0[:, None]) & (pixels <= y1[:, None]))
+    for x in [x0, x1]:
+        images[image_idx[k], y, x[k]] = colors[k]
+
+    return images
+
+
+def contact_sheet(columns, padding=2):
+    """put images side by side
+
+    Args:
+        columns: list of (R, S, S, 3) images, e.g. predicted, refined and gt layouts
+
+    Returns:
+        sheet: (R * (S + 2 * padding), len(columns) * (S + 2 * padding), 3) uint8
+    """
+    # (R, C, S, S, 3)
+    grid = np.stack(columns, axis=1)
+    grid = np.pad(grid, ((0, 0), (0, 0), (padding, padding), (padding, padding), (0, 0)))
+    R, C, H, W, _ = grid.shape
+
+    return grid.transpose((0, 2, 1, 3, 4)).reshape((R * H, C * W, 3))
+
+
+class Renderer:
+    """draw layouts in a pool of background processes
+
+    the caller only copies the layout into numpy arrays,
+    PNG encoding and disk writes happen in the workers.
+    at most max_pending layouts are queued, draw_boxes waits for
+    the oldest one beyond that
+
+    Args:
+        num_workers: number of worker processes, 0 draws in the caller
+        max_pending: max number of queued layouts
+    """
+    def __init__(self, num_workers=2, max_pending=32):
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+
+        if num_workers > 0:
+            # spawn, so the workers do not inherit the threads of tensorflow runtime
+            self.executor = ProcessPoolExecutor(
+                max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = None
+
+    def draw_boxes(self, obj_cls, boxes, output_path):
+        obj_cls = np.asarray(obj_cls)
+        boxes = np.asarray(boxes)
+
+        if self.executor is None:
+            draw_boxes(obj_cls, boxes, output_path)
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+
+        self.pending.append(self.executor.submit(draw_boxes, obj_cls, boxes, output_path))
+
+    def flush(self):
+        """wait until every queued layout is written"""
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.flush()
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,28 @@
+import time
+
+
+class Schedule:
+    """decide when a periodic task of the training loop is due
+
+    a task is due every `every_steps` steps or after `every_secs` seconds
+    since it last ran, whichever comes first. 0 disables a cadence
+
+    Args:
+        every_steps: step interval
+        every_secs: wall-clock interval in seconds
+    """
+    def __init__(self, every_steps=0, every_secs=0):
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.last_time = time.time()
+
+    def is_due(self, step):
+        now = time.time()
+
+        due = (self.every_steps > 0 and (step + 1) % self.every_steps == 0) \
+              or (self.every_secs > 0 and now - self.last_time >= self.every_secs)
+
+        if due:
+            self.last_time = now
+
+        return due
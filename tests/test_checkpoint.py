@@ -0,0 +1,39 @@
+import os
+import glob
+import tensorflow as tf
+
+from models.checkpoint import AsyncCheckpointer
+
+
+def test_max_to_keep_in_relative_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    max_to_keep = 2
+
+    ckpt = tf.train.Checkpoint(v=tf.Variable(0.))
+    checkpointer = AsyncCheckpointer(ckpt, 'checkpoints', max_to_keep=max_to_keep, staging_dir=str(tmp_path / 'staging'))
+
+    for step in range(max_to_keep + 2):
+        ckpt.v.assign(float(step))
+        checkpointer.save(step)
+    checkpointer.close()
+
+    assert len(glob.glob(os.path.join('checkpoints', '*.data-*'))) == max_to_keep
+
+    latest = tf.train.latest_checkpoint('checkpoints')
+    assert latest is not None and latest.endswith('ckpt-%d' % (max_to_keep + 1))
+    # snapshots are written with Checkpoint.write, without save_counter
+    tf.train.Checkpoint(v=tf.Variable(0.)).restore(latest).assert_existing_objects_matched()
+
+
+def test_close_keeps_given_staging_dir(tmp_path):
+    staging_dir = tmp_path / 'staging'
+    staging_dir.mkdir()
+    (staging_dir / 'other').write_text('kept')
+
+    ckpt = tf.train.Checkpoint(v=tf.Variable(0.))
+    # without directory, snapshots are discarded
+    checkpointer = AsyncCheckpointer(ckpt, None, max_to_keep=1, staging_dir=str(staging_dir))
+    checkpointer.save(0)
+    checkpointer.close()
+
+    assert os.listdir(str(staging_dir)) == ['other']
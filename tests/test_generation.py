@@ -0,0 +1,110 @@
+import numpy as np
+import tensorflow as tf
+
+from models.data import build_vocab
+from models.generation import NDNGeneration
+from benchmarks.run import category_list, pos_relation_list, synthesize_batch
+
+
+def batched_layouts(layout_sizes, rng):
+    """a batch of synthetic layouts of layout_sizes elements, with random input features
+
+    Returns:
+        objs: (O, ), boxes: (O, 4), obj_vecs: (O, 64), pred_vecs: (T, 64), s: (T, ), o: (T, )
+    """
+    vocab = build_vocab(category_list, pos_relation_list)
+    batches = [synthesize_batch(vocab, layout_size, 1, rng) for layout_size in layout_sizes]
+    offsets = np.cumsum([0] + [len(batch[0]) for batch in batches[:-1]]).astype(np.int32)
+    objs = np.concatenate([batch[0] for batch in batches])
+    boxes = np.concatenate([batch[1] for batch in batches])
+    pos_triples = np.concatenate([
+        batch[2] + np.array([offset, 0, offset], dtype=np.int32) for batch, offset in zip(batches, offsets)])
+
+    obj_vecs = tf.constant(rng.standard_normal((len(objs), 64)).astype(np.float32))
+    pred_vecs = tf.constant(rng.standard_normal((len(pos_triples), 64)).astype(np.float32))
+
+    return tf.constant(objs), tf.constant(boxes), obj_vecs, pred_vecs, tf.constant(pos_triples[:, 0]), tf.constant(pos_triples[:, 2])
+
+
+def deterministic_generation(**kwargs):
+    generation = NDNGeneration(**kwargs)
+    # the same noise in every mode
+    generation.reparameterize = lambda mu, var, eps=None: .5 * tf.exp(var * .5) + mu
+
+    return generation
+
+
+def teacher_forced_loss_and_gradients(generation, teacher_forcing, objs, obj_vecs, pred_vecs, boxes, s, o):
+    generation.teacher_forcing = teacher_forcing
+
+    with tf.GradientTape() as tape:
+        result = generation(objs, obj_vecs, pred_vecs, boxes, s, o, training=True)
+        loss = tf.reduce_sum(tf.abs(result['pred_boxes'] - boxes)) \
+               + tf.reduce_sum(result['mu'] * result['var']) \
+               + tf.reduce_sum(result['mu_prior'] * result['var_prior'])
+
+    gradients = tape.gradient(
+        loss, generation.trainable_variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+    return loss, gradients
+
+
+def test_parallel_teacher_forcing_matches_sequential():
+    rng = np.random.RandomState(0)
+
+    # layouts of different sizes in one batch, node counts of pooling
+    # exceed the layout size from 3 elements on
+    for layout_sizes in [(2, 4), (5, 7)]:
+        objs, boxes, obj_vecs, pred_vecs, s, o = batched_layouts(layout_sizes, rng)
+
+        generation = deterministic_generation()
+
+        # every variable exists once the model is built, start both modes from the same weights
+        weights = generation.get_weights()
+
+        sequential_loss, sequential_gradients = teacher_forced_loss_and_gradients(
+            generation, 'sequential', objs, obj_vecs, pred_vecs, boxes, s, o)
+        sequential_weights = generation.get_weights()
+
+        generation.set_weights(weights)
+        parallel_loss, parallel_gradients = teacher_forced_loss_and_gradients(
+            generation, 'parallel', objs, obj_vecs, pred_vecs, boxes, s, o)
+        parallel_weights = generation.get_weights()
+
+        np.testing.assert_allclose(parallel_loss.numpy(), sequential_loss.numpy(), rtol=1e-4)
+        for parallel_gradient, sequential_gradient in zip(parallel_gradients, sequential_gradients):
+            np.testing.assert_allclose(
+                tf.convert_to_tensor(parallel_gradient).numpy(), tf.convert_to_tensor(sequential_gradient).numpy(), rtol=1e-3, atol=1e-5)
+
+        # moving statistics of batch normalization are updated once per step in both modes
+        for parallel_weight, sequential_weight in zip(parallel_weights, sequential_weights):
+            np.testing.assert_allclose(parallel_weight, sequential_weight, rtol=1e-4, atol=1e-6)
+
+
+def test_batched_decoding_matches_sequential():
+    rng = np.random.RandomState(0)
+
+    for layout_sizes in [(2, 2), (2, 4), (5, 7)]:
+        objs, boxes, obj_vecs, pred_vecs, s, o = batched_layouts(layout_sizes, rng)
+
+        sequential = deterministic_generation(decode_mode='sequential')
+        batched = deterministic_generation(decode_mode='batched')
+        batched.set_weights(sequential.get_weights())
+
+        np.testing.assert_allclose(
+            batched(objs, obj_vecs, pred_vecs, boxes, s, o, training=False)['pred_boxes'].numpy(),
+            sequential(objs, obj_vecs, pred_vecs, boxes, s, o, training=False)['pred_boxes'].numpy(),
+            rtol=1e-4, atol=1e-5)
+
+
+def test_sampled_candidates_match_sequential():
+    rng = np.random.RandomState(0)
+    objs, boxes, obj_vecs, pred_vecs, s, o = batched_layouts((3, 5), rng)
+    num_samples = 3
+
+    sequential = deterministic_generation(decode_mode='sequential')
+    pred_boxes = sequential(objs, obj_vecs, pred_vecs, boxes, s, o, training=False)['pred_boxes'].numpy()
+
+    # with the same noise, every sample is the sequential decoding
+    samples = sequential.sample(objs, obj_vecs, pred_vecs, s, o, num_samples)['pred_boxes'].numpy()
+    np.testing.assert_allclose(samples, np.tile(pred_boxes, [num_samples, 1]), rtol=1e-4, atol=1e-5)
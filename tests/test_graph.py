@@ -0,0 +1,131 @@
+import numpy as np
+import tensorflow as tf
+
+from models.data import build_vocab
+from models.graph import GraphTripleConvStack, dense_index
+from benchmarks.run import category_list, pos_relation_list, synthesize_batch
+
+
+DIMS = [(16, 32, 24), (24, 32, 24)]
+
+
+def batched_graph(layout_sizes, rng):
+    """a batch of synthetic layouts of layout_sizes elements
+
+    Returns:
+        obj_vecs: (O, 16), pred_vecs: (T, 16), edges: (T, 2)
+    """
+    vocab = build_vocab(category_list, pos_relation_list)
+
+    all_pos_triples, offset = [], 0
+    for layout_size in layout_sizes:
+        objs, _, pos_triples = synthesize_batch(vocab, layout_size, 1, rng)
+        all_pos_triples.append(pos_triples + np.array([offset, 0, offset], dtype=np.int32))
+        offset += len(objs)
+    pos_triples = np.concatenate(all_pos_triples)
+
+    obj_vecs = tf.constant(rng.standard_normal((offset, DIMS[0][0])).astype(np.float32))
+    pred_vecs = tf.constant(rng.standard_normal((len(pos_triples), DIMS[0][0])).astype(np.float32))
+
+    return obj_vecs, pred_vecs, tf.constant(pos_triples[:, [0, 2]])
+
+
+def outputs_and_gradients(stack, obj_vecs, pred_vecs, edges, training):
+    with tf.GradientTape() as tape:
+        tape.watch([obj_vecs, pred_vecs])
+        new_obj_vecs, new_pred_vecs = stack(obj_vecs, pred_vecs, edges, training=training)
+        # weights, so the gradients of the outputs are not all ones
+        loss = tf.reduce_sum(tf.sin(new_obj_vecs)) + tf.reduce_sum(tf.cos(new_pred_vecs))
+
+    gradients = tape.gradient(
+        loss, [obj_vecs, pred_vecs] + stack.trainable_variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+    return [new_obj_vecs, new_pred_vecs] + gradients
+
+
+def assert_all_close(actual, desired):
+    for a, d in zip(actual, desired):
+        np.testing.assert_allclose(
+            tf.convert_to_tensor(a).numpy(), tf.convert_to_tensor(d).numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_dense_index_of_layouts_of_different_sizes():
+    # layouts of 3 and 2 nodes, complete graphs without self edges
+    edges = tf.constant([[0, 1], [0, 2], [1, 0], [1, 2], [2, 0], [2, 1], [3, 4], [4, 3]])
+
+    obj_index, pred_index, dense_shape = dense_index(edges, 5)
+
+    np.testing.assert_array_equal(obj_index.numpy(), [[0, 0], [0, 1], [0, 2], [1, 0], [1, 1]])
+    np.testing.assert_array_equal(pred_index.numpy(), [
+        [0, 0, 1], [0, 0, 2], [0, 1, 0], [0, 1, 2], [0, 2, 0], [0, 2, 1], [1, 0, 1], [1, 1, 0]])
+    np.testing.assert_array_equal(dense_shape.numpy(), [2, 3])
+
+
+def test_dense_engine_matches_sparse():
+    rng = np.random.RandomState(0)
+    obj_vecs, pred_vecs, edges = batched_graph([3, 5, 2], rng)
+
+    sparse = GraphTripleConvStack(DIMS, engine='sparse')
+    dense = GraphTripleConvStack(DIMS, engine='dense')
+    dense.set_weights(sparse.get_weights())
+
+    for training in [True, False]:
+        assert_all_close(
+            outputs_and_gradients(dense, obj_vecs, pred_vecs, edges, training),
+            outputs_and_gradients(sparse, obj_vecs, pred_vecs, edges, training))
+
+    # moving statistics are updated alike
+    assert_all_close(dense.get_weights(), sparse.get_weights())
+
+
+def test_factorized_matches_unfactorized():
+    rng = np.random.RandomState(0)
+    obj_vecs, pred_vecs, edges = batched_graph([4, 3], rng)
+
+    for engine in ['sparse', 'dense']:
+        unfactorized = GraphTripleConvStack(DIMS, engine=engine, factorized=False)
+        factorized = GraphTripleConvStack(DIMS, engine=engine, factorized=True)
+        factorized.set_weights(unfactorized.get_weights())
+
+        for training in [True, False]:
+            assert_all_close(
+                outputs_and_gradients(factorized, obj_vecs, pred_vecs, edges, training),
+                outputs_and_gradients(unfactorized, obj_vecs, pred_vecs, edges, training))
+
+
+def test_checkpoints_are_interchangeable(tmp_path):
+    rng = np.random.RandomState(0)
+    obj_vecs, pred_vecs, edges = batched_graph([4, 2], rng)
+
+    saved = GraphTripleConvStack(DIMS, engine='sparse', factorized=False)
+    # train once, so the moving statistics are saved too
+    saved(obj_vecs, pred_vecs, edges, training=True)
+    path = tf.train.Checkpoint(stack=saved).write(str(tmp_path / 'ckpt'))
+
+    restored = GraphTripleConvStack(DIMS, engine='dense', factorized=True)
+    # written with Checkpoint.write, without save_counter
+    tf.train.Checkpoint(stack=restored).restore(path).assert_existing_objects_matched()
+
+    assert_all_close(
+        restored(obj_vecs, pred_vecs, edges, training=False),
+        saved(obj_vecs, pred_vecs, edges, training=False))
+
+
+def test_recompute_matches_without_recompute():
+    rng = np.random.RandomState(0)
+    obj_vecs, pred_vecs, edges = batched_graph([4, 3], rng)
+
+    for engine in ['sparse', 'dense']:
+        stack = GraphTripleConvStack(DIMS, engine=engine)
+        recomputed = GraphTripleConvStack(DIMS, engine=engine, recompute=True)
+        recomputed.set_weights(stack.get_weights())
+
+        # eagerly and compiled, the backward pass of tf.recompute_grad is built differently
+        for compiled in [False, True]:
+            run = tf.function(outputs_and_gradients, experimental_relax_shapes=True) if compiled else outputs_and_gradients
+            assert_all_close(
+                run(recomputed, obj_vecs, pred_vecs, edges, True),
+                run(stack, obj_vecs, pred_vecs, edges, True))
+
+            # the recomputation does not update the moving statistics again
+            assert_all_close(recomputed.get_weights(), stack.get_weights())